@@ -0,0 +1,174 @@
+
+"""Record the notification traffic of an application and replay it for benchmarking the notification system.
+
+Usage:
+
+from application.debug.notification import NotificationRecorder, NotificationReplayer
+
+recorder = NotificationRecorder('notifications.log')
+recorder.start()
+...
+recorder.stop()
+
+replayer = NotificationReplayer('notifications.log')
+report = replayer.replay()             # post the notifications as fast as possible
+report = replayer.replay(speed=1.0)    # post the notifications with their original timing
+
+"""
+
+import sys
+
+from threading import Lock
+from time import sleep, time
+from zope.interface import implements
+
+from application.notification import IObserver, Any, NotificationCenter, NotificationStatistics
+from application.notification_bridge import encode_notification, decode_notifications
+
+
+__all__ = 'NotificationRecorder', 'NotificationReplayer', 'ReplayReport', 'read_notifications'
+
+
+def read_notifications(filename):
+    """Iterate over the (name, sender, data, timestamp) tuples of the notifications recorded in a file"""
+    with open(filename, 'rb') as log_file:
+        buffer = ''
+        while True:
+            chunk = log_file.read(1 << 20)
+            if not chunk:
+                break
+            buffer += chunk
+            notifications, offset = decode_notifications(buffer)
+            buffer = buffer[offset:]
+            for notification in notifications:
+                yield notification
+
+
+class NotificationRecorder(object):
+    """
+    An observer that writes the notifications posted on a NotificationCenter
+    to a file, in the same compact binary encoding that the NotificationBridge
+    uses. The senders are recorded by identity (strings and numbers as they
+    are, other objects by their type and id) and the notification data by its
+    fields.
+
+    The recorder subscribes with a high priority, so the recorded timestamps
+    are taken before the other observers handle the notifications.
+    """
+
+    implements(IObserver)
+
+    def __init__(self, filename, center=None, names=Any, priority=sys.maxint):
+        self.filename = filename
+        self.center = center or NotificationCenter()
+        self.names = names
+        self.priority = priority
+        self.count = 0
+        self.lock = Lock()
+        self._file = None
+
+    def start(self):
+        """Open the file and start recording the notifications"""
+        with self.lock:
+            if self._file is not None:
+                return
+            self._file = open(self.filename, 'wb')
+        for name in [Any] if self.names is Any else self.names:
+            self.center.add_observer(self, name=name, priority=self.priority)
+
+    def stop(self):
+        """Stop recording the notifications and close the file"""
+        for name in [Any] if self.names is Any else self.names:
+            self.center.discard_observer(self, name=name)
+        with self.lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def handle_notification(self, notification):
+        record = encode_notification(notification)
+        with self.lock:
+            if self._file is not None:
+                self._file.write(record)
+                self.count += 1
+
+
+class ReplayReport(object):
+    """The results of replaying a recording"""
+
+    def __init__(self, count, elapsed, max_lag, statistics):
+        self.count = count
+        self.elapsed = elapsed
+        self.max_lag = max_lag  # the largest delay of a notification from its scheduled time, when replaying with the original timing
+        self.statistics = statistics  # a NotificationStatistics snapshot, with the time taken by each observer to handle the notifications
+
+    @property
+    def throughput(self):
+        return self.count / self.elapsed if self.elapsed else 0.0
+
+    def __str__(self):
+        lines = ['%d notifications in %.3f seconds (%d notifications/s, %.3f seconds maximum lag)' % (self.count, self.elapsed, self.throughput, self.max_lag)]
+        for observer, statistics in sorted(self.statistics['observers'].iteritems(), key=lambda item: item[1]['total_time'], reverse=True):
+            lines.append('  %-60s %8d notifications %10.6f average %10.6f maximum seconds' % (observer, statistics['count'], statistics['average_time'], statistics['max_time']))
+        return '\n'.join(lines)
+
+
+class NotificationReplayer(object):
+    """
+    Post the notifications from a recording made by a NotificationRecorder on
+    a NotificationCenter and report the throughput and the time it took each
+    observer to handle them. The notifications are posted with the recorded
+    senders (the identity recorded for them), with NotificationData for the
+    recorded data fields.
+    """
+
+    def __init__(self, filename, center=None):
+        self.filename = filename
+        self.center = center or NotificationCenter()
+        self.notifications = list(read_notifications(filename))
+
+    def replay(self, speed=None):
+        """
+        Post the recorded notifications and return a ReplayReport. If speed is
+        None the notifications are posted as fast as possible, otherwise they
+        are posted with the intervals between them divided by speed (1.0 keeps
+        the original timing). The center collects delivery statistics during
+        the replay. The report is made after the asynchronous and concurrent
+        observers handled the notifications, but the time taken by the event
+        loop observers and by the coalescing observers whose window did not
+        expire yet may be missing from it.
+        """
+        if speed is not None and speed <= 0:
+            raise ValueError('speed must be a positive number or None')
+        center = self.center
+        post_notification = center.post_notification
+        previous_statistics, center.statistics = center.statistics, NotificationStatistics()
+        max_lag = 0.0
+        try:
+            start_time = time()
+            if speed is None:
+                for name, sender, data, timestamp in self.notifications:
+                    post_notification(name, sender, data)
+            elif self.notifications:
+                first_timestamp = self.notifications[0][3]
+                for name, sender, data, timestamp in self.notifications:
+                    delay = start_time + (timestamp - first_timestamp) / speed - time()
+                    if delay > 0:
+                        sleep(delay)
+                    else:
+                        max_lag = max(max_lag, -delay)
+                    post_notification(name, sender, data)
+            elapsed = time() - start_time
+            self._wait_for_deliveries()
+            statistics = center.statistics.snapshot()
+        finally:
+            center.statistics = previous_statistics
+        return ReplayReport(len(self.notifications), elapsed, max_lag, statistics)
+
+    def _wait_for_deliveries(self):
+        # Wait until the thread pool and the dispatcher (if the center has one) handled the notifications posted from this thread
+        self.center.concurrent_jobs.wait()
+        dispatcher = self.center.current_dispatcher
+        if dispatcher is not None:
+            dispatcher.flush()
+
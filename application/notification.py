@@ -1,20 +1,29 @@
 
 """A notification system"""
 
+import fnmatch
+import re
 import weakref
-from collections import deque
+from bisect import bisect_left
+from collections import OrderedDict, deque
 from datetime import datetime
-from threading import Lock
+from itertools import count, groupby
+from operator import itemgetter
+from threading import Condition, Event, Lock, current_thread
 from time import time
+from types import FunctionType, MethodType
 from zope.interface import Interface, implements
 
 from application import log
 from application.python.descriptor import ThreadLocal
+from application.python.queue import BatchEventQueue, TimerWheel, Block, DropOldest, DropNewest
+from application.python.threadpool import ThreadPool
 from application.python.types import Singleton, MarkerType
 from application.python.weakref import weakobjectmap
 
 
-__all__ = 'Any', 'UnknownSender', 'IObserver', 'NotificationData', 'Notification', 'NotificationCenter', 'ObserverWeakrefProxy'
+__all__ = ('Any', 'UnknownSender', 'IObserver', 'IBatchObserver', 'NotificationData', 'NotificationDataType', 'FixedNotificationData', 'Notification', 'NotificationCenter', 'NotificationDispatcher', 'NotificationStatistics', 'NamePattern', 'Coalesce', 'ObserverWeakrefProxy',
+           'Block', 'DropOldest', 'DropNewest')
 
 
 class Any(object):
@@ -27,6 +36,10 @@ class UnknownSender(object):
     __metaclass__ = MarkerType
 
 
+class MissingAttribute(object):
+    __metaclass__ = MarkerType
+
+
 class IObserver(Interface):
     """Interface describing a Notification Observer"""
 
@@ -35,6 +48,14 @@ class IObserver(Interface):
         """Function used to handle a posted Notification"""
 
 
+class IBatchObserver(IObserver):
+    """Interface describing an Observer that can handle a batch of Notifications in one call"""
+
+    # noinspection PyMethodMayBeStatic
+    def handle_notifications(self, notifications):
+        """Function used to handle the Notifications from a batch posted with post_notifications"""
+
+
 class ObserverWeakrefProxy(object):
     """
     A proxy that allows an observer to be weakly referenced and automatically
@@ -70,49 +91,816 @@ class ObserverWeakrefProxy(object):
             observer.handle_notification(notification)
 
 
+class WeakMethodObserver(object):
+    """
+    A bound method subscribed as an observer, which references the object it
+    is bound to weakly and removes its remaining registrations when the object
+    is released. The same WeakMethodObserver is returned for the same method
+    of the same object, so it can be used to identify the subscriptions.
+    """
+
+    __slots__ = 'object_ref', 'function', '__weakref__'
+
+    method_map = weakobjectmap()  # object -> {function: WeakMethodObserver}
+    lock = Lock()
+
+    def __new__(cls, method):
+        obj, function = method.im_self, method.im_func
+        with cls.lock:
+            try:
+                return cls.method_map[obj][function]
+            except KeyError:
+                instance = object.__new__(cls)
+                instance.object_ref = weakref.ref(obj, instance.cleanup)
+                instance.function = function
+                cls.method_map.setdefault(obj, {})[function] = instance
+                return instance
+
+    def __repr__(self):
+        return '<%s for %s of %r>' % (self.__class__.__name__, self.function.__name__, self.object_ref())
+
+    # noinspection PyUnusedLocal
+    def cleanup(self, ref):
+        for notification_center in NotificationCenter.__instances__.itervalues():
+            notification_center.purge_observer(self)
+
+    def __call__(self, notification):
+        obj = self.object_ref()
+        if obj is not None:
+            self.function(obj, notification)
+
+
 class NotificationData(object):
     """Object containing the notification data"""
 
     def __init__(self, **kwargs):
-        self.__dict__.update(kwargs)
+        self.__dict__ = kwargs
 
     def __repr__(self):
         return '%s(%s)' % (self.__class__.__name__, ', '.join('%s=%r' % (name, value) for name, value in self.__dict__.iteritems()))
 
 
+class NotificationDataType(type):
+    """Metaclass for notification data classes with a fixed set of fields"""
+
+    def __new__(mcls, name, bases, dictionary):
+        if isinstance(dictionary.get('__slots__'), basestring):
+            dictionary['__slots__'] = dictionary['__slots__'],
+        dictionary.setdefault('__slots__', ())  # keep subclasses that don't define any fields without a __dict__
+        return super(NotificationDataType, mcls).__new__(mcls, name, bases, dictionary)
+
+    def __init__(cls, name, bases, dictionary):
+        super(NotificationDataType, cls).__init__(name, bases, dictionary)
+        fields = []
+        for base in reversed(cls.__mro__):
+            fields.extend(field for field in base.__dict__.get('__slots__', ()) if field not in fields)
+        cls.__fields__ = tuple(fields)
+
+
+class FixedNotificationData(object):
+    """
+    Base class for notification data with a fixed set of fields, which are
+    declared by listing their names in the __slots__ attribute of subclasses:
+
+        class CallEndedData(FixedNotificationData):
+            __slots__ = 'reason', 'duration'
+
+    Instances are created like NotificationData, using keyword arguments, but
+    don't have a __dict__, which makes them smaller and faster to create.
+    """
+
+    __metaclass__ = NotificationDataType
+
+    def __init__(self, **kwargs):
+        for name, value in kwargs.iteritems():
+            setattr(self, name, value)
+
+    def __repr__(self):
+        return '%s(%s)' % (self.__class__.__name__, ', '.join('%s=%r' % (name, getattr(self, name)) for name in self.__fields__ if hasattr(self, name)))
+
+
 class Notification(object):
-    """Object representing a notification"""
+    """
+    Object representing a notification.
 
-    def __init__(self, name, sender=UnknownSender, data=NotificationData()):
+    The timestamp is taken when it is first needed (it is taken before
+    handing the notification to another thread or event loop for delivery,
+    otherwise when first accessed by an observer), which avoids the cost
+    for the notifications whose observers don't look at it.
+    """
+
+    __slots__ = 'name', 'sender', 'data', 'center', '_timestamp', '_datetime', '_utcdatetime'
+
+    def __init__(self, name, sender=UnknownSender, data=NotificationData(), center=None):
         if name is Any or sender is Any:
             raise ValueError('name and/or sender must not be the special object Any')
         self.name = name
         self.sender = sender
         self.data = data
-        self.timestamp = time()
+        self.center = center
+
+    @property
+    def timestamp(self):
+        try:
+            return self._timestamp
+        except AttributeError:
+            self._timestamp = time()
+            return self._timestamp
+
+    @timestamp.setter
+    def timestamp(self, value):
+        self._timestamp = value
 
     @property
     def datetime(self):
-        return self.__dict__.get('datetime') or self.__dict__.setdefault('datetime', datetime.fromtimestamp(self.timestamp))
+        try:
+            return self._datetime
+        except AttributeError:
+            self._datetime = datetime.fromtimestamp(self.timestamp)
+            return self._datetime
 
     @property
     def utcdatetime(self):
-        return self.__dict__.get('utcdatetime') or self.__dict__.setdefault('utcdatetime', datetime.utcfromtimestamp(self.timestamp))
+        try:
+            return self._utcdatetime
+        except AttributeError:
+            self._utcdatetime = datetime.utcfromtimestamp(self.timestamp)
+            return self._utcdatetime
 
     def __repr__(self):
         return '%s(%r, %r, %r)' % (self.__class__.__name__, self.name, self.sender, self.data)
 
 
+class NotificationDispatcher(BatchEventQueue):
+    """
+    Deliver notifications to observers from a dedicated thread, in the order
+    in which they were handed to it (taking them off the backlog in batches
+    of up to 1000 notifications). The backlog of notifications waiting to
+    be delivered is limited to `backlog' entries and the `overflow' policy
+    (one of the Block, DropOldest, DropNewest or Raise policies of the
+    application.python.queue module) decides what happens when it is full.
+    The notifications that the observers post from the dispatcher's thread
+    are always added to the backlog, regardless of its limit, as only that
+    same thread could make room for them.
+    """
+
+    def __init__(self, name=None, backlog=10000, overflow=Block):
+        BatchEventQueue.__init__(self, self._deliver, name=name, capacity=backlog, overflow=overflow)
+
+    def stop(self, force_exit=False):
+        """Stop accepting notifications and terminate the delivery thread once the backlog is delivered (or right away if force_exit is True)"""
+        self.ignore_events()
+        BatchEventQueue.stop(self, force_exit)
+
+    def flush(self, timeout=None):
+        """
+        Wait until the notifications that were added on the backlog before
+        calling this are delivered, for up to timeout seconds (or forever if
+        timeout is None). Returns True if they were delivered and False if
+        the timeout expired or the dispatcher stopped before delivering them.
+        """
+        if current_thread() is self:
+            raise RuntimeError('cannot flush the dispatcher from its own thread')
+        flushed = FlushMarker()
+        self._requeue((self, flushed, Notification('NotificationDispatcherFlushed')))
+        deadline = None if timeout is None else time() + timeout
+        while not flushed.event.isSet() and self.isAlive():
+            remaining = 0.1 if deadline is None else min(deadline - time(), 0.1)
+            if remaining <= 0:
+                break
+            flushed.event.wait(remaining)
+        return flushed.event.isSet()
+
+    def _discard_oldest(self):
+        # Must be called with the queue mutex held. The control events and the flush markers are never discarded. Returns False if there is no notification to discard
+        events = self.queue.queue
+        for index, event in enumerate(events):
+            if event.__class__ is tuple and event[1].__class__ is not FlushMarker:
+                del events[index]
+                return True
+        return False
+
+    @staticmethod
+    def _deliver(events):
+        for observer, handler, notification in events:
+            center = notification.center
+            statistics = center.statistics if center is not None else None
+            start_time = time()
+            try:
+                handler(notification)
+            except Exception:
+                log.exception('Unhandled exception in notification observer %r while handling notification %r' % (observer, notification.name))
+            if statistics is not None and handler.__class__ not in deferred_deliveries:
+                statistics.record(observer, notification.name, time() - start_time)
+
+
+class FlushMarker(object):
+    __slots__ = 'event'
+
+    def __init__(self):
+        self.event = Event()
+
+    def __call__(self, notification):
+        self.event.set()
+
+
+class AsynchronousDelivery(object):
+    __slots__ = 'dispatcher', 'observer', 'handler'
+
+    def __init__(self, dispatcher, observer, handler):
+        self.dispatcher = dispatcher
+        self.observer = observer
+        self.handler = handler
+
+    def __call__(self, notification):
+        notification.timestamp  # take the timestamp now, before the notification is delivered later from a different context
+        self.dispatcher.put((self.observer, self.handler, notification))
+
+
+class EventLoopDispatcher(object):
+    """
+    Deliver notifications to observers from an asyncio (or compatible) event
+    loop. Notifications posted from any thread are accumulated and delivered
+    in a single loop wakeup. If an observer's handle_notification returns a
+    coroutine, the coroutine is scheduled as a task on the loop.
+    """
+
+    def __init__(self, loop):
+        self.loop_ref = weakref.ref(loop)
+        self.pending = []
+        self.lock = Lock()
+
+    def put(self, event):
+        loop = self.loop_ref()
+        if loop is None:
+            return
+        with self.lock:
+            self.pending.append(event)
+            if len(self.pending) > 1:
+                return  # the loop was already woken up to deliver the pending notifications
+        try:
+            loop.call_soon_threadsafe(self._deliver)
+        except Exception:
+            # the loop cannot be woken up (it may be closed), so discard the pending notifications, otherwise they would accumulate without ever being delivered
+            with self.lock:
+                pending, self.pending = self.pending, []
+            log.exception('Cannot deliver %d notification(s) from event loop %r' % (len(pending), loop))
+
+    def _deliver(self):
+        with self.lock:
+            pending, self.pending = self.pending, []
+        loop = self.loop_ref()
+        for observer, handler, notification in pending:
+            center = notification.center
+            statistics = center.statistics if center is not None else None
+            start_time = time()
+            try:
+                result = handler(notification)
+                if hasattr(result, 'send'):  # a coroutine (a generator or a wrapper around one)
+                    task = loop.create_task(result)
+                    task.add_done_callback(CoroutineDoneCallback(observer, notification))
+            except Exception:
+                log.exception('Unhandled exception in notification observer %r while handling notification %r' % (observer, notification.name))
+            if statistics is not None:
+                statistics.record(observer, notification.name, time() - start_time)
+
+
+class CoroutineDoneCallback(object):
+    __slots__ = 'observer', 'notification'
+
+    def __init__(self, observer, notification):
+        self.observer = observer
+        self.notification = notification
+
+    def __call__(self, task):
+        if not task.cancelled() and task.exception() is not None:
+            exception = task.exception()
+            log.exception('Unhandled exception in notification observer %r while handling notification %r' % (self.observer, self.notification.name), exc_info=(type(exception), exception, None))
+
+
+class ConcurrentDelivery(object):
+    __slots__ = 'center', 'threadpool', 'observer', 'handler'
+
+    def __init__(self, center, threadpool, observer, handler):
+        self.center = center
+        self.threadpool = threadpool
+        self.observer = observer
+        self.handler = handler
+
+    def __call__(self, notification):
+        notification.timestamp  # take the timestamp now, before the notification is delivered later from a different context
+        jobs = self.center.concurrent_jobs
+        jobs.add()
+        self.threadpool.run(self._deliver, notification, jobs)
+
+    def _deliver(self, notification, jobs):
+        statistics = self.center.statistics
+        start_time = time()
+        try:
+            self.handler(notification)
+        except Exception:
+            log.exception('Unhandled exception in notification observer %r while handling notification %r' % (self.observer, notification.name))
+        finally:
+            if statistics is not None:
+                statistics.record(self.observer, notification.name, time() - start_time)
+            jobs.done()
+
+
+class ConcurrentJobs(object):
+    """The concurrent deliveries started by the notifications posted from a thread that did not finish yet"""
+
+    def __init__(self):
+        self.count = 0
+        self.condition = Condition(Lock())
+
+    def add(self):
+        with self.condition:
+            self.count += 1
+
+    def done(self):
+        with self.condition:
+            self.count -= 1
+            if self.count == 0:
+                self.condition.notify_all()
+
+    def wait(self):
+        with self.condition:
+            while self.count:
+                self.condition.wait()
+
+
+class NamePattern(object):
+    """
+    A shell style pattern (as understood by the fnmatch module) that can be
+    used in place of a notification name to subscribe to all notifications
+    whose names match it, for example NamePattern('SIPSession*').
+    """
+
+    __slots__ = 'pattern', 'prefix', 'regex'
+
+    def __init__(self, pattern):
+        if not isinstance(pattern, basestring):
+            raise TypeError('pattern must be a string')
+        self.pattern = pattern
+        self.prefix = pattern[:-1] if pattern.endswith('*') and not any(char in pattern[:-1] for char in '*?[') else None  # patterns that only match a prefix are indexed in a trie
+        self.regex = re.compile(fnmatch.translate(pattern))
+
+    def match(self, name):
+        """Check if the notification name matches the pattern"""
+        return isinstance(name, basestring) and self.regex.match(name) is not None
+
+    def __eq__(self, other):
+        if isinstance(other, NamePattern):
+            return self.pattern == other.pattern
+        return NotImplemented
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    def __hash__(self):
+        return hash((self.__class__, self.pattern))
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, self.pattern)
+
+
+class NamePatternIndex(object):
+    """
+    Find the subscribed name patterns that match a notification name. Prefix
+    patterns are looked up in a trie and the result is remembered for every
+    name, so the cost doesn't depend on the number of patterns after a name
+    was seen once. The patterns are added and removed with the lock of the
+    center held, while match is called without it.
+    """
+
+    def __init__(self):
+        self.patterns = {}  # pattern -> number of subscription keys that use it
+        self.trie = {}  # the prefix patterns are stored under the None key of the node corresponding to the prefix
+        self.other_patterns = set()
+        self.matches = {}  # notification name -> tuple of matching patterns
+        self.version = 0  # incremented when the patterns change, before the remembered matches are dropped
+
+    def __nonzero__(self):
+        return bool(self.patterns)
+
+    def add(self, pattern):
+        if pattern in self.patterns:
+            self.patterns[pattern] += 1
+            return
+        self.patterns[pattern] = 1
+        if pattern.prefix is not None:
+            node = self.trie
+            for char in pattern.prefix:
+                node = node.setdefault(char, {})
+            node[None] = pattern
+        else:
+            self.other_patterns.add(pattern)
+        self.version += 1
+        self.matches.clear()
+
+    def remove(self, pattern):
+        self.patterns[pattern] -= 1
+        if self.patterns[pattern] > 0:
+            return
+        del self.patterns[pattern]
+        if pattern.prefix is not None:
+            nodes = [self.trie]
+            for char in pattern.prefix:
+                nodes.append(nodes[-1][char])
+            del nodes[-1][None]
+            for index in reversed(xrange(len(pattern.prefix))):  # prune the nodes that no longer lead to any pattern
+                if nodes[index + 1]:
+                    break
+                del nodes[index][pattern.prefix[index]]
+        else:
+            self.other_patterns.discard(pattern)
+        self.version += 1
+        self.matches.clear()
+
+    def match(self, name):
+        try:
+            return self.matches[name]
+        except KeyError:
+            pass
+        version = self.version
+        matches = []
+        if isinstance(name, basestring):
+            node = self.trie
+            matches.append(node.get(None))
+            for char in name:
+                node = node.get(char)
+                if node is None:
+                    break
+                matches.append(node.get(None))
+            matches.extend(pattern for pattern in list(self.other_patterns) if pattern.match(name))
+        matches = self.matches[name] = tuple(pattern for pattern in matches if pattern is not None)
+        if self.version != version:  # the patterns changed while matching them, so the result must not be remembered
+            self.matches.pop(name, None)
+        return matches
+
+
+class DeliveryStatistics(object):
+    __slots__ = 'count', 'total_time', 'max_time', 'histogram', 'skipped'
+
+    def __init__(self, histogram_size):
+        self.count = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.histogram = [0] * histogram_size
+        self.skipped = 0
+
+    def snapshot(self):
+        return dict(count=self.count, total_time=self.total_time, max_time=self.max_time, average_time=self.total_time / self.count if self.count else 0.0, histogram=self.histogram[:], skipped=self.skipped)
+
+
+class NotificationStatistics(object):
+    """
+    Statistics about the time taken by the observers to handle notifications,
+    kept per notification name and per observer, with a histogram of the
+    handling times and a log of the handlers that took longer than the slow
+    threshold. Setting a NotificationStatistics instance as the statistics
+    attribute of a NotificationCenter enables collecting them for it.
+
+    The histogram has one bucket for each of the `histogram_bounds' (which
+    counts the handling times up to that bound) and a last bucket for the
+    handling times that exceed all of them. The statistics per notification
+    name also count the deliveries that were skipped because the notification
+    didn't match the filter of a subscription. The handling times of the
+    asynchronous, concurrent and event loop observers are measured in the
+    context that delivers the notifications to them.
+    """
+
+    histogram_bounds = (0.00001, 0.0001, 0.001, 0.01, 0.1, 1)
+
+    def __init__(self, slow_threshold=0.1, slow_log_size=100):
+        self.slow_threshold = slow_threshold
+        self.lock = Lock()
+        self.notifications = {}
+        self.observers = weakobjectmap()
+        self.unreferenceable_observers = {}  # observers that do not support weak references
+        self.slow_handlers = deque(maxlen=slow_log_size)
+
+    def record(self, observer, name, duration):
+        """Record the time the observer took to handle a notification with the given name (None for a batch of notifications)"""
+        histogram_index = bisect_left(self.histogram_bounds, duration)
+        with self.lock:
+            try:
+                statistics_list = [self.observers[observer]]
+            except KeyError:
+                try:
+                    statistics_list = [self.observers.setdefault(observer, DeliveryStatistics(len(self.histogram_bounds) + 1))]
+                except TypeError:
+                    statistics_list = [self.unreferenceable_observers.setdefault(observer, DeliveryStatistics(len(self.histogram_bounds) + 1))]
+            if name is not None:
+                statistics_list.append(self.notifications.get(name) or self.notifications.setdefault(name, DeliveryStatistics(len(self.histogram_bounds) + 1)))
+            for statistics in statistics_list:
+                statistics.count += 1
+                statistics.total_time += duration
+                statistics.max_time = max(statistics.max_time, duration)
+                statistics.histogram[histogram_index] += 1
+            if duration >= self.slow_threshold:
+                self.slow_handlers.append((time(), name, self.label(observer), duration))
+
+    @staticmethod
+    def label(observer):
+        """Return the label that identifies the observer in the snapshots: its representation, followed by its id if it doesn't already include it, as different observers can have the same representation"""
+        representation = repr(observer)
+        address = '0x%x' % id(observer)
+        return representation if address in representation else '%s at %s' % (representation, address)
+
+    def record_skipped(self, name, count):
+        """Record that a notification with the given name was not delivered to count observers, because it didn't match their filters"""
+        with self.lock:
+            statistics = self.notifications.get(name) or self.notifications.setdefault(name, DeliveryStatistics(len(self.histogram_bounds) + 1))
+            statistics.skipped += count
+
+    def reset(self):
+        """Discard all the collected statistics"""
+        with self.lock:
+            self.notifications.clear()
+            self.observers.clear()
+            self.unreferenceable_observers.clear()
+            self.slow_handlers.clear()
+
+    def snapshot(self):
+        """
+        Return the collected statistics as a dictionary with the statistics
+        per notification name, the statistics per observer (indexed by the
+        observer's label) and the slow handler log, which lists the
+        (timestamp, notification name, observer label, duration) of the
+        handlers that took longer than the slow threshold.
+        """
+        with self.lock:
+            observers = self.observers.items() + self.unreferenceable_observers.items()
+            return dict(notifications={name: statistics.snapshot() for name, statistics in self.notifications.iteritems()},
+                        observers={self.label(observer): statistics.snapshot() for observer, statistics in observers},
+                        slow_handlers=list(self.slow_handlers),
+                        histogram_bounds=self.histogram_bounds)
+
+
+class Coalesce(object):
+    """
+    Subscription option that makes the repeated notifications with the same
+    name and sender be delivered to the observer only once. Without a window,
+    the notifications are held until the center finishes delivering all the
+    notifications queued in the posting thread, otherwise they are held for
+    `window' seconds since the first one and then they are delivered from
+    the center's dispatcher thread. Only the last notification is delivered,
+    unless `merge' is True, in which case the data of all of them is merged,
+    with the later values overriding the earlier ones.
+    """
+
+    __slots__ = 'window', 'merge'
+
+    def __init__(self, window=None, merge=False):
+        if window is not None and window <= 0:
+            raise ValueError('window must be a positive number of seconds or None')
+        self.window = window
+        self.merge = merge
+
+    def __eq__(self, other):
+        if isinstance(other, Coalesce):
+            return self.window == other.window and self.merge == other.merge
+        return NotImplemented
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    def __repr__(self):
+        return '%s(window=%r, merge=%r)' % (self.__class__.__name__, self.window, self.merge)
+
+    def combine(self, notification, new_notification):
+        """Return the notification to deliver in place of the two given ones"""
+        if not self.merge:
+            return new_notification
+        data, new_data = notification.data, new_notification.data
+        if isinstance(data, NotificationData) and isinstance(new_data, NotificationData):
+            merged_data = new_data.__class__.__new__(new_data.__class__)
+            merged_data.__dict__ = dict(data.__dict__, **new_data.__dict__)
+        elif isinstance(new_data, FixedNotificationData) and type(data) is type(new_data):
+            merged_data = new_data.__class__.__new__(new_data.__class__)
+            for name in new_data.__fields__:
+                if hasattr(new_data, name):
+                    setattr(merged_data, name, getattr(new_data, name))
+                elif hasattr(data, name):
+                    setattr(merged_data, name, getattr(data, name))
+        else:
+            merged_data = new_data
+        merged_notification = Notification(new_notification.name, new_notification.sender, merged_data, new_notification.center)
+        merged_notification.timestamp = new_notification.timestamp
+        return merged_notification
+
+
+class CoalescingDelivery(object):
+    __slots__ = 'center', 'observer', 'handler', 'policy'
+
+    def __init__(self, center, observer, handler, policy):
+        self.center = center
+        self.observer = observer
+        self.handler = handler
+        self.policy = policy
+
+    def __call__(self, notification):
+        if self.policy.window is None:
+            self.center.coalesced.add(self, notification)
+        else:
+            self.center.coalesced_in_window.add(self, notification)
+
+
+# The handlers that pass the notifications on to be delivered later, where the time taken by the observers is measured
+deferred_deliveries = frozenset([AsynchronousDelivery, ConcurrentDelivery, CoalescingDelivery])
+
+
+class CoalescedNotifications(object):
+    """Notifications held by the coalescing subscriptions until the posting thread's notification queue is drained"""
+
+    def __init__(self):
+        self.notifications = OrderedDict()
+        self.queued = False
+
+    def add(self, delivery, notification):
+        key = delivery.observer, notification.name, notification.sender
+        if key in self.notifications:
+            self.notifications[key] = delivery, delivery.policy.combine(self.notifications[key][1], notification)
+            delivery.center._count_coalesced()
+        else:
+            self.notifications[key] = delivery, notification
+        if not self.queued:
+            self.queued = True
+            delivery.center.queue.append(self)
+
+    def process(self, center, queue):
+        if len(queue) > 1:
+            queue.append(self)  # wait until the notifications queued after this are delivered
+            return
+        self.queued = False
+        notifications, self.notifications = self.notifications, OrderedDict()
+        statistics = center.statistics
+        for delivery, notification in notifications.itervalues():
+            if statistics is not None:
+                center._deliver_with_statistics(notification, [(delivery.observer, delivery.handler)], statistics)
+            else:
+                try:
+                    delivery.handler(notification)
+                except Exception:
+                    log.exception('Unhandled exception in notification observer %r while handling notification %r' % (delivery.observer, notification.name))
+
+
+class WindowCoalescedNotifications(object):
+    """Notifications held by the coalescing subscriptions until their window expires"""
+
+    def __init__(self, center):
+        self.center = center
+        self.notifications = {}
+        self.lock = Lock()
+
+    def add(self, delivery, notification):
+        key = delivery.observer, notification.name, notification.sender
+        with self.lock:
+            coalesced = key in self.notifications
+            if coalesced:
+                self.notifications[key] = delivery, delivery.policy.combine(self.notifications[key][1], notification)
+            else:
+                self.notifications[key] = delivery, notification
+        if coalesced:
+            self.center._count_coalesced()
+            return
+        TimerWheel().schedule(time() + delivery.policy.window, self._expire, key)
+
+    def _expire(self, key):
+        with self.lock:
+            delivery, notification = self.notifications.pop(key)
+        # the notification is added regardless of the backlog limit, as waiting for room would hold up the timer wheel and dropping it would lose the notifications coalesced in it
+        self.center.dispatcher._requeue((delivery.observer, delivery.handler, notification))
+
+
+class FilteredDelivery(object):
+    """Delivers notifications to the consecutive observers (in delivery order) of a name and sender that subscribed with a filter"""
+
+    __slots__ = 'indexes', 'predicates', 'size'
+
+    def __init__(self, subscriptions):
+        indexes = {}  # tuple of attribute names -> {tuple of attribute values: list of (position, observer, handler)}
+        self.predicates = []
+        for position, (subscription, handler) in enumerate(subscriptions):
+            if callable(subscription.filter):
+                self.predicates.append((position, subscription.filter, subscription.observer, handler))
+            else:
+                names = tuple(sorted(subscription.filter))
+                values = tuple(subscription.filter[name] for name in names)
+                indexes.setdefault(names, {}).setdefault(values, []).append((position, subscription.observer, handler))
+        self.indexes = indexes.items()
+        self.size = len(subscriptions)
+
+    def __repr__(self):
+        return '<%s of %d observers>' % (self.__class__.__name__, self.size)
+
+    def __call__(self, notification):
+        for position, observer, handler in self.match(notification):
+            try:
+                handler(notification)
+            except Exception:
+                log.exception('Unhandled exception in notification observer %r while handling notification %r' % (observer, notification.name))
+
+    def match(self, notification):
+        """Return the (position, observer, handler) entries for the observers whose filter the notification matches, in delivery order"""
+        data = notification.data
+        matched = []
+        for names, index in self.indexes:
+            try:
+                entries = index.get(tuple(getattr(data, name, MissingAttribute) for name in names))
+            except TypeError:  # an unhashable attribute value cannot be equal to the hashable filter values
+                entries = None
+            if entries:
+                matched.extend(entries)
+        for position, predicate, observer, handler in self.predicates:
+            try:
+                accepted = predicate(notification)
+            except Exception:
+                log.exception('Unhandled exception in the filter of notification observer %r while handling notification %r' % (observer, notification.name))
+                accepted = False
+            if accepted:
+                matched.append((position, observer, handler))
+        if len(self.indexes) + len(self.predicates) > 1:
+            matched.sort(key=itemgetter(0))
+        return matched
+
+    def deliver_with_statistics(self, notification, statistics):
+        matched = self.match(notification)
+        if len(matched) < self.size:
+            statistics.record_skipped(notification.name, self.size - len(matched))
+        NotificationCenter._deliver_with_statistics(notification, [(observer, handler) for position, observer, handler in matched], statistics)
+
+
+class NotificationBatch(list):
+    """Notifications posted together with post_notifications"""
+
+    def __init__(self):
+        super(NotificationBatch, self).__init__()
+        self.drain = False  # deliver the notifications posted by the handlers after each notification, as when posting them one by one outside of a handler
+
+    def process(self, center, queue):
+        center._deliver_batch(self, queue)
+
+
+class Subscription(object):
+    """The options used to register an observer for a notification name and sender"""
+
+    __slots__ = 'observer', 'asynchronous', 'concurrent', 'loop', 'coalesce', 'priority', 'filter', 'sequence'
+
+    def __init__(self, observer, asynchronous=False, concurrent=False, loop=None, coalesce=None, priority=0, filter=None, sequence=0):
+        self.observer = observer
+        self.asynchronous = asynchronous
+        self.concurrent = concurrent
+        self.loop = loop
+        self.coalesce = coalesce
+        self.priority = priority
+        self.filter = filter
+        self.sequence = sequence  # orders the subscriptions with the same priority by the time they were made
+
+    def __eq__(self, other):
+        if isinstance(other, Subscription):
+            return all(getattr(self, name) == getattr(other, name) for name in self.__slots__ if name != 'sequence')
+        return NotImplemented
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+
 class NotificationCenter(object):
     """
     A NotificationCenter allows observers to subscribe to receive notifications
     identified by name and sender and will distribute the posted notifications
     according to those subscriptions.
+
+    The subscriptions are stored as mappings from observers to their options,
+    which are replaced (never modified in place) while holding the lock, so
+    they can be read from any thread without locking. Posting a notification
+    only needs the lock the first time a name and sender pair is resolved
+    after the subscriptions that affect it have changed.
+
+    Notifications are delivered synchronously, in the thread that posted them,
+    unless the center is asynchronous or the observer subscribed with the
+    asynchronous option, in which case they are handed to the center's
+    dispatcher and delivered from its thread, or the observer subscribed with
+    the concurrent option, in which case they are delivered from the threads
+    of the center's thread pool, or the observer subscribed with an event
+    loop, in which case they are delivered from that loop.
+
+    The observers of a notification are called in the order of the priority
+    they subscribed with (highest first) and those with the same priority in
+    the order they subscribed. The order is established when the observers
+    of a notification name and sender are resolved, not when posting.
     """
 
     __metaclass__ = Singleton
 
     queue = ThreadLocal(deque)
+    coalesced = ThreadLocal(CoalescedNotifications)
+    concurrent_jobs = ThreadLocal(ConcurrentJobs)
 
     def __init__(self, name='default'):
         """
@@ -123,21 +911,148 @@ class NotificationCenter(object):
         self.name = name
         self.observers = {}
         self.lock = Lock()
+        self.__dict__['asynchronous'] = False
+        self.__dict__['dispatcher'] = None
+        self.__dict__['threadpool'] = None
+        self.statistics = None  # set it to a NotificationStatistics instance to collect delivery statistics
+        self.coalesced_notifications = 0  # the number of notifications absorbed by coalescing subscriptions
+        self._coalesced_lock = Lock()  # protects coalesced_notifications, which is updated from all the posting threads
+        self.coalesced_in_window = WindowCoalescedNotifications(self)
+        self._senders = {}  # senders that appear in subscriptions, mapped to the number of subscription keys that mention them
+        self._subscriptions = {}  # observer -> set of (name, sender) subscription keys
+        self._name_patterns = NamePatternIndex()
+        self._dispatch_cache = {}  # notification name -> {sender: tuple of (observer, handler) pairs}
+        self._generation = 0  # incremented when the subscriptions change, before the cached observers are dropped
+        self._loop_dispatchers = weakobjectmap()  # event loop -> EventLoopDispatcher
+        self._subscription_sequence = count()
+
+    @property
+    def asynchronous(self):
+        """Deliver all notifications through the dispatcher, regardless of the option the observers subscribed with"""
+        return self.__dict__['asynchronous']
+
+    @asynchronous.setter
+    def asynchronous(self, value):
+        with self.lock:
+            self.__dict__['asynchronous'] = bool(value)
+            self._invalidate(Any, Any)
+
+    @property
+    def dispatcher(self):
+        """The NotificationDispatcher used for asynchronous delivery (one with the default settings is created when first needed)"""
+        with self.lock:
+            return self._get_dispatcher()
+
+    @dispatcher.setter
+    def dispatcher(self, dispatcher):
+        if not isinstance(dispatcher, NotificationDispatcher):
+            raise TypeError('dispatcher must be a NotificationDispatcher instance')
+        with self.lock:
+            old_dispatcher = self.__dict__['dispatcher']
+            self.__dict__['dispatcher'] = dispatcher
+            if dispatcher.ident is None:
+                dispatcher.start()
+            self._invalidate(Any, Any)
+        if old_dispatcher is not None and old_dispatcher is not dispatcher:
+            old_dispatcher.stop()
+
+    @property
+    def current_dispatcher(self):
+        """The NotificationDispatcher used for asynchronous delivery or None if there is none yet (unlike dispatcher, it doesn't create one)"""
+        return self.__dict__['dispatcher']
+
+    @property
+    def threadpool(self):
+        """The ThreadPool used for concurrent delivery (one with the default settings is created when first needed)"""
+        with self.lock:
+            return self._get_threadpool()
+
+    @threadpool.setter
+    def threadpool(self, threadpool):
+        if not isinstance(threadpool, ThreadPool):
+            raise TypeError('threadpool must be a ThreadPool instance')
+        with self.lock:
+            old_threadpool = self.__dict__['threadpool']
+            self.__dict__['threadpool'] = threadpool
+            threadpool.start()
+            self._invalidate(Any, Any)
+        if old_threadpool is not None and old_threadpool is not threadpool:
+            old_threadpool.stop()
 
-    def add_observer(self, observer, name=Any, sender=Any):
+    def add_observer(self, observer, name=Any, sender=Any, asynchronous=False, concurrent=False, loop=None, coalesce=None, priority=0, filter=None, weak=True):
         """
         Register an observer to receive notifications identified by a name and a
         sender.
 
+        The observer is either an object that implements IObserver or a
+        callable, which is called with the notification. A bound method only
+        keeps a weak reference to the object it is bound to and its
+        subscriptions are removed when the object is released, unless `weak'
+        is False, in which case the center references the method and calls it
+        directly, which is faster, but keeps the object alive until the
+        method is removed.
+
         If `name' is Any, the observer will receive all notifications sent by
-        the specified sender. If `sender' is Any, it will receive notifications
-        sent by all senders, rather than from only one; if `sender' is
-        UnknownSender, the observer will only receive anonymous notifications.
+        the specified sender. If `name' is a NamePattern, it will receive the
+        notifications whose name matches the pattern. If `sender' is Any, it
+        will receive notifications sent by all senders, rather than from only
+        one; if `sender' is UnknownSender, the observer will only receive
+        anonymous notifications.
+
+        If `asynchronous' is True, the notifications are delivered to the
+        observer from the center's dispatcher thread. If `concurrent' is True,
+        each notification is delivered to the observer from one of the threads
+        of the center's thread pool, so the observers that do blocking work
+        handle it in parallel (and possibly out of order). If `loop' is an
+        asyncio (or compatible) event loop, the notifications are delivered
+        from that loop and the observer's handle_notification can be a
+        coroutine, which will be scheduled as a task on the loop. If `coalesce'
+        is a Coalesce instance, repeated notifications with the same name and
+        sender are delivered to the observer only once, as described by it.
+
+        The observers with a higher `priority' (an integer) receive each
+        notification before those with a lower one. Observers that have the
+        same priority receive it in the order they subscribed.
+
+        If `filter' is a dictionary, the observer only receives the
+        notifications whose data has all the attributes in it with the given
+        values, and if it is a callable, only the notifications for which it
+        returns True when called with the notification. The notifications are
+        matched against the equality filters through an index, so the
+        observers they don't match cost a lookup rather than a call.
+
+        Registering an observer again for the same name and sender replaces
+        the previous options. If a notification matches multiple subscriptions
+        of the same observer, it is only delivered once, using the options of
+        the most specific one.
         """
-        if not IObserver.providedBy(observer):
-            raise TypeError('observer must implement the IObserver interface')
+        observer = self._get_observer_key(observer, weak)
+        if not isinstance(observer, (FunctionType, MethodType, WeakMethodObserver)) and not IObserver.providedBy(observer) and not callable(observer):
+            raise TypeError('observer must implement the IObserver interface or be callable')
+        if not isinstance(priority, (int, long)):
+            raise TypeError('priority must be an integer')
+        if isinstance(filter, dict):
+            filter = dict(filter)
+            try:
+                hash(tuple(filter.itervalues()))
+            except TypeError:
+                raise TypeError('the values of an attribute filter must be hashable')
+        elif filter is not None and not callable(filter):
+            raise TypeError('filter must be a dictionary of attribute values or a callable')
+        subscription = Subscription(observer, asynchronous, concurrent, loop, coalesce, priority, filter)
         with self.lock:
-            self.observers.setdefault((name, sender), set()).add(observer)
+            observer_map = self.observers.get((name, sender), {})
+            if observer_map.get(observer) != subscription:
+                subscription.sequence = next(self._subscription_sequence)
+                if not observer_map and sender is not Any:
+                    self._senders[sender] = self._senders.get(sender, 0) + 1
+                if not observer_map and isinstance(name, NamePattern):
+                    self._name_patterns.add(name)
+                observer_map = observer_map.copy()
+                observer_map[observer] = subscription
+                self.observers[(name, sender)] = observer_map
+                self._subscriptions.setdefault(observer, set()).add((name, sender))
+                self._invalidate(name, sender)
 
     def remove_observer(self, observer, name=Any, sender=Any):
         """
@@ -149,14 +1064,10 @@ class NotificationCenter(object):
         See discard_observer for a variant that doesn't raise KeyError if
         the observer is not registered.
         """
+        keys = self._get_observer_keys(observer)
         with self.lock:
-            try:
-                observer_set = self.observers[(name, sender)]
-                observer_set.remove(observer)
-            except KeyError:
+            if not any(self._remove_subscription(key, name, sender) for key in keys):
                 raise KeyError('observer %r not registered for %r events from %r' % (observer, name, sender))
-            if not observer_set:
-                del self.observers[(name, sender)]
 
     def discard_observer(self, observer, name=Any, sender=Any):
         """
@@ -168,47 +1079,321 @@ class NotificationCenter(object):
         See remove_observer for a variant that raises KeyError if the
         observer is not registered.
         """
+        keys = self._get_observer_keys(observer)
         with self.lock:
-            observer_set = self.observers.get((name, sender), None)
-            if observer_set is not None:
-                observer_set.discard(observer)
-                if not observer_set:
-                    del self.observers[(name, sender)]
+            for key in keys:
+                if self._remove_subscription(key, name, sender):
+                    break
 
     def purge_observer(self, observer):
         """Remove all the observer's subscriptions."""
+        keys = self._get_observer_keys(observer)
         with self.lock:
-            subscriptions = [(key, observer_set) for key, observer_set in self.observers.iteritems() if observer in observer_set]
-            for key, observer_set in subscriptions:
-                observer_set.remove(observer)
-                if not observer_set:
-                    del self.observers[key]
+            for key in keys:
+                for name, sender in list(self._subscriptions.get(key, ())):
+                    self._remove_subscription(key, name, sender)
+
+    def has_observers(self, name, sender=UnknownSender):
+        """
+        Check if there are any observers subscribed to receive notifications
+        with the given name from the given sender. This can be used to avoid
+        building an expensive NotificationData when nobody would receive it.
+        """
+        return bool(self._get_observers(name, sender))
 
-    def post_notification(self, name, sender=UnknownSender, data=NotificationData()):
+    def post_notification(self, name, sender=UnknownSender, data=NotificationData(), wait=False):
         """
         Post a notification which will be delivered to all observers whose
         subscription matches the name and sender attributes of the notification.
+
+        If no observer is subscribed to the notification at the time it is
+        posted, the notification is discarded without being created.
+
+        If `wait' is True, return only after the concurrent observers finished
+        handling the notifications posted from this thread. This has no effect
+        when posting from inside a notification handler, as the notification
+        is only delivered after the handler returns.
         """
 
-        notification = Notification(name, sender, data)
-        notification.center = self
+        if name is Any or sender is Any:
+            raise ValueError('name and/or sender must not be the special object Any')
+        observers = self._get_observers(name, sender)
+        if not observers:
+            return
+
+        notification = Notification(name, sender, data, self)
         queue = self.queue
         queue.append(notification)
         # noinspection PyTypeChecker
         if len(queue) > 1:  # This is true if we post a notification from inside a notification handler
             return
 
-        empty_set = set()
+        self._process_queue(queue, observers=observers)
+        if wait:
+            self.concurrent_jobs.wait()
 
+    def post_notifications(self, notifications, wait=False):
+        """
+        Post multiple notifications, given as (name, sender, data) tuples. They
+        are delivered in order, just like posting them one by one would, but
+        the observers are only looked up once for each name and sender pair in
+        the batch. Observers that provide IBatchObserver and are subscribed to
+        be notified synchronously receive all the notifications they match
+        from the batch in one handle_notifications call, after the rest of the
+        observers have handled the whole batch, and the coalescing observers
+        receive the notifications they hold once the whole batch was delivered.
+        The `wait' argument has the same meaning as for post_notification.
+        """
+
+        batch = NotificationBatch()
+        for name, sender, data in notifications:
+            if name is Any or sender is Any:
+                raise ValueError('name and/or sender must not be the special object Any')
+            if self._get_observers(name, sender):
+                batch.append(Notification(name, sender, data, self))
+        if not batch:
+            return
+
+        queue = self.queue
+        queue.append(batch)
+        # noinspection PyTypeChecker
+        if len(queue) > 1:  # This is true if we post the notifications from inside a notification handler
+            return
+
+        batch.drain = True
+        self._process_queue(queue)
+        if wait:
+            self.concurrent_jobs.wait()
+
+    def _process_queue(self, queue, hold_coalesced=False, observers=None):
+        # If given, observers are the ones that post_notification already resolved for the first notification on the queue
         while queue:
             notification = queue[0]
-            observers = (self.observers.get((Any, Any), empty_set) |
-                         self.observers.get((Any, notification.sender), empty_set) |
-                         self.observers.get((notification.name, Any), empty_set) |
-                         self.observers.get((notification.name, notification.sender), empty_set))
-            for observer in observers:
+            if notification.__class__ is not Notification:  # a NotificationBatch or the CoalescedNotifications waiting for the queue to drain
+                if hold_coalesced and len(queue) == 1 and notification.__class__ is CoalescedNotifications:
+                    break  # the coalesced notifications wait for the rest of the batch
+                notification.process(self, queue)
+            else:
+                if observers is None:
+                    observers = self._get_observers(notification.name, notification.sender)
+                if self.statistics is not None:
+                    self._deliver_with_statistics(notification, observers, self.statistics)
+                else:
+                    for observer, handler in observers:
+                        try:
+                            handler(notification)
+                        except Exception:
+                            log.exception('Unhandled exception in notification observer %r while handling notification %r' % (observer, notification.name))
+            observers = None
+            queue.popleft()
+
+    @staticmethod
+    def _deliver_with_statistics(notification, observers, statistics):
+        for observer, handler in observers:
+            if handler.__class__ is FilteredDelivery:
+                handler.deliver_with_statistics(notification, statistics)
+                continue
+            if handler.__class__ in deferred_deliveries:
                 try:
-                    observer.handle_notification(notification)
+                    handler(notification)
                 except Exception:
                     log.exception('Unhandled exception in notification observer %r while handling notification %r' % (observer, notification.name))
-            queue.popleft()
+                continue
+            start_time = time()
+            try:
+                handler(notification)
+            except Exception:
+                log.exception('Unhandled exception in notification observer %r while handling notification %r' % (observer, notification.name))
+            statistics.record(observer, notification.name, time() - start_time)
+
+    def _deliver_batch(self, batch, queue):
+        statistics = self.statistics
+        resolved = {}
+        batch_observers = OrderedDict()  # observer -> list of notifications
+        for notification in batch:
+            key = notification.name, notification.sender
+            try:
+                observers, observers_by_batch = resolved[key]
+            except KeyError:
+                observers = []
+                observers_by_batch = []
+                for observer, handler in self._get_observers(*key):
+                    if isinstance(handler, MethodType) and IBatchObserver.providedBy(observer):  # only the synchronous subscriptions have the bound handle_notification as handler
+                        observers_by_batch.append(observer)
+                    else:
+                        observers.append((observer, handler))
+                resolved[key] = observers, observers_by_batch
+            if statistics is not None:
+                self._deliver_with_statistics(notification, observers, statistics)
+            else:
+                for observer, handler in observers:
+                    try:
+                        handler(notification)
+                    except Exception:
+                        log.exception('Unhandled exception in notification observer %r while handling notification %r' % (observer, notification.name))
+            for observer in observers_by_batch:
+                batch_observers.setdefault(observer, []).append(notification)
+            if batch.drain and len(queue) > 1:  # deliver the notifications posted by the handlers before the rest of the batch
+                queue.popleft()
+                self._process_queue(queue, hold_coalesced=True)
+                queue.appendleft(batch)
+        for observer, notifications in batch_observers.iteritems():
+            start_time = time()
+            try:
+                observer.handle_notifications(notifications)
+            except Exception:
+                log.exception('Unhandled exception in notification observer %r while handling a batch of %d notifications' % (observer, len(notifications)))
+            if statistics is not None:
+                statistics.record(observer, None, time() - start_time)
+
+    def _count_coalesced(self):
+        with self._coalesced_lock:
+            self.coalesced_notifications += 1
+
+    def _get_dispatcher(self):
+        # Must be called with the lock held
+        dispatcher = self.__dict__['dispatcher']
+        if dispatcher is None:
+            dispatcher = self.__dict__['dispatcher'] = NotificationDispatcher(name='%s-%s' % (NotificationDispatcher.__name__, self.name))
+            dispatcher.start()
+        return dispatcher
+
+    def _get_threadpool(self):
+        # Must be called with the lock held
+        threadpool = self.__dict__['threadpool']
+        if threadpool is None:
+            threadpool = self.__dict__['threadpool'] = ThreadPool(name='%s-%s' % (self.__class__.__name__, self.name))
+            threadpool.start()
+        return threadpool
+
+    def _get_observers(self, name, sender):
+        # The observers are resolved without the lock, from the subscription maps, which are replaced rather than modified. The result is not cached
+        # if the subscriptions changed in the meantime. Senders that are not mentioned by any subscription share the observers resolved for Any,
+        # which keeps them from being referenced by the cache
+        try:
+            return self._dispatch_cache[name][sender if sender in self._senders else Any]
+        except KeyError:
+            generation = self._generation
+            if sender not in self._senders:
+                sender = Any
+            observers = self.observers
+            empty_map = {}
+            subscriptions = {}  # later updates override the options of the less specific subscriptions
+            subscriptions.update(observers.get((Any, Any), empty_map))
+            subscriptions.update(observers.get((Any, sender), empty_map))
+            if self._name_patterns:
+                for pattern in self._name_patterns.match(name):
+                    subscriptions.update(observers.get((pattern, Any), empty_map))
+                    subscriptions.update(observers.get((pattern, sender), empty_map))
+            subscriptions.update(observers.get((name, Any), empty_map))
+            subscriptions.update(observers.get((name, sender), empty_map))
+            ordered_subscriptions = sorted(subscriptions.itervalues(), key=lambda item: (-item.priority, item.sequence))
+            resolved = []
+            for filtered, group in groupby(ordered_subscriptions, key=lambda item: item.filter is not None):
+                if filtered:  # the consecutive filtered subscriptions are delivered together through a FilteredDelivery
+                    delivery = FilteredDelivery([(subscription, self._get_handler(subscription)) for subscription in group])
+                    resolved.append((delivery, delivery))
+                else:
+                    resolved.extend((subscription.observer, self._get_handler(subscription)) for subscription in group)
+            resolved = tuple(resolved)
+            sender_map = self._dispatch_cache.setdefault(name, {})
+            sender_map[sender] = resolved
+            if self._generation != generation:
+                sender_map.pop(sender, None)
+            return resolved
+
+    @staticmethod
+    def _get_observer_key(observer, weak=True):
+        # Bound methods are identified by a WeakMethodObserver, unless they are subscribed with weak=False or the object they are bound to cannot be weakly referenced
+        if weak and isinstance(observer, MethodType) and observer.im_self is not None:
+            try:
+                return WeakMethodObserver(observer)
+            except TypeError:
+                return observer
+        return observer
+
+    @staticmethod
+    def _get_observer_keys(observer):
+        # The keys that can identify the subscriptions of an observer. A bound method can have subscriptions made with weak=False, which are identified
+        # by the method itself and are looked up first, and weak ones, which are identified by its WeakMethodObserver
+        if isinstance(observer, MethodType) and observer.im_self is not None:
+            keys = []
+            try:
+                hash(observer)
+            except TypeError:  # the object it is bound to is not hashable, so the method can only be subscribed weakly
+                pass
+            else:
+                keys.append(observer)
+            try:
+                keys.append(WeakMethodObserver(observer))
+            except TypeError:
+                pass
+            return keys or [observer]
+        return [observer]
+
+    def _get_handler(self, subscription):
+        # Must be called without holding the lock, which is taken to create the dispatchers and the thread pool when they are first needed
+        observer = subscription.observer
+        if isinstance(observer, (FunctionType, MethodType, WeakMethodObserver)) or not IObserver.providedBy(observer):
+            handler = observer
+        else:
+            handler = observer.handle_notification
+        if subscription.loop is not None:
+            with self.lock:
+                loop_dispatcher = self._loop_dispatchers.get(subscription.loop)
+                if loop_dispatcher is None:
+                    loop_dispatcher = self._loop_dispatchers[subscription.loop] = EventLoopDispatcher(subscription.loop)
+            handler = AsynchronousDelivery(loop_dispatcher, subscription.observer, handler)
+        elif subscription.concurrent:
+            handler = ConcurrentDelivery(self, self.threadpool, subscription.observer, handler)
+        elif subscription.asynchronous or self.asynchronous:
+            handler = AsynchronousDelivery(self.dispatcher, subscription.observer, handler)
+        if subscription.coalesce is not None:
+            handler = CoalescingDelivery(self, subscription.observer, handler, subscription.coalesce)
+        return handler
+
+    def _remove_subscription(self, observer, name, sender):
+        # Must be called with the lock held. Returns False if the subscription doesn't exist
+        observer_map = self.observers.get((name, sender))
+        if observer_map is None or observer not in observer_map:
+            return False
+        observer_map = observer_map.copy()
+        del observer_map[observer]
+        subscriptions = self._subscriptions[observer]
+        subscriptions.remove((name, sender))
+        if not subscriptions:
+            del self._subscriptions[observer]
+        if observer_map:
+            self.observers[(name, sender)] = observer_map
+        else:
+            del self.observers[(name, sender)]
+            if isinstance(name, NamePattern):
+                self._name_patterns.remove(name)
+            if sender is not Any:
+                self._senders[sender] -= 1
+                if self._senders[sender] == 0:
+                    del self._senders[sender]
+                    name = Any  # the sender is no longer mentioned by any subscription, so drop all its cache entries
+        self._invalidate(name, sender)
+        return True
+
+    def _invalidate(self, name, sender):
+        # Must be called with the lock held. Drops the cached observers that depend on the (name, sender) subscription key. The posting threads add
+        # entries to the cache without the lock, so it is only iterated through the lists returned by keys() and values()
+        self._generation += 1
+        dispatch_cache = self._dispatch_cache
+        if name is Any and sender is Any:
+            dispatch_cache.clear()
+        elif name is Any:
+            for sender_map in dispatch_cache.values():  # notification names are a small and bounded set
+                sender_map.pop(sender, None)
+        elif isinstance(name, NamePattern):
+            for notification_name in [notification_name for notification_name in dispatch_cache.keys() if name.match(notification_name)]:
+                if sender is Any:
+                    del dispatch_cache[notification_name]
+                else:
+                    dispatch_cache[notification_name].pop(sender, None)
+        elif sender is Any:
+            dispatch_cache.pop(name, None)
+        elif name in dispatch_cache:
+            dispatch_cache[name].pop(sender, None)
@@ -0,0 +1,286 @@
+
+"""Forward notifications between the notification centers of different processes"""
+
+import cPickle
+import socket
+import struct
+
+from itertools import count
+from threading import Lock, Thread
+from zope.interface import implements
+
+from application import log
+from application.notification import IObserver, Any, UnknownSender, NotificationCenter, NotificationData, FixedNotificationData, Block, DropOldest, DropNewest
+from application.python.queue import BatchEventQueue
+
+
+__all__ = 'NotificationBridge', 'RemoteSender', 'encode_notification', 'decode_notifications'
+
+
+class RemoteSender(object):
+    """
+    The sender of the notifications received from a peer process. Senders
+    that are equal in the peer process are represented by equal RemoteSender
+    objects, so observers can subscribe to notifications from a given one.
+    """
+
+    __slots__ = 'peer', 'identity'
+
+    def __init__(self, peer, identity):
+        self.peer = peer
+        self.identity = identity
+
+    def __eq__(self, other):
+        if isinstance(other, RemoteSender):
+            return self.peer == other.peer and self.identity == other.identity
+        return NotImplemented
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    def __hash__(self):
+        return hash((self.peer, self.identity))
+
+    def __repr__(self):
+        return '%s(%r, %r)' % (self.__class__.__name__, self.peer, self.identity)
+
+
+_header = struct.Struct('!I')
+
+
+def encode_notification(notification):
+    """
+    Encode the name, sender, data and timestamp of a notification as a length
+    prefixed binary record. Senders that are strings, numbers or UnknownSender (which
+    is encoded as None) are kept as they are, the other senders are encoded
+    as a string that identifies the sender object while it is alive. The
+    NotificationData and FixedNotificationData are encoded as dictionaries
+    with their fields, any other data is pickled as it is.
+    """
+    sender = notification.sender
+    if sender is UnknownSender:
+        sender = None
+    elif isinstance(sender, RemoteSender):
+        sender = sender.identity
+    elif not isinstance(sender, (basestring, int, long, float)):
+        sender = '%s@%x' % (sender.__class__.__name__, id(sender))
+    data = notification.data
+    if isinstance(data, NotificationData):
+        data = True, data.__dict__
+    elif isinstance(data, FixedNotificationData):
+        data = True, {name: getattr(data, name) for name in data.__fields__ if hasattr(data, name)}
+    else:
+        data = False, data
+    payload = cPickle.dumps((notification.name, sender, data, notification.timestamp), cPickle.HIGHEST_PROTOCOL)
+    return _header.pack(len(payload)) + payload
+
+
+def decode_notifications(buffer, offset=0):
+    """
+    Decode the complete records from the buffer, starting at offset. Return
+    a list with the (name, sender, data, timestamp) tuples of the decoded
+    notifications and the offset of the first record that is not complete
+    in the buffer.
+    Senders encoded as None are decoded as UnknownSender.
+    """
+    notifications = []
+    header_size = _header.size
+    buffer_size = len(buffer)
+    while buffer_size - offset >= header_size:
+        length, = _header.unpack_from(buffer, offset)
+        if buffer_size - offset - header_size < length:
+            break
+        name, sender, (is_notification_data, data), timestamp = cPickle.loads(buffer[offset+header_size:offset+header_size+length])
+        offset += header_size + length
+        notifications.append((name, UnknownSender if sender is None else sender, NotificationData(**data) if is_notification_data else data, timestamp))
+    return notifications, offset
+
+
+class BridgePeer(object):
+    def __init__(self, bridge, sock, name, names, backlog, overflow):
+        self.bridge = bridge
+        self.socket = sock
+        self.name = name
+        self.names = names
+        self.sent = 0
+        self.received = 0
+        self.failed = False
+        self.stopping = False
+        self.sender = BatchEventQueue(self._send_records, name='%s-sender-%s' % (bridge.__class__.__name__, name), max_batch_size=bridge.batch_size, capacity=backlog, overflow=overflow)
+        self.receiver_thread = Thread(target=self._receive_records, name='%s-receiver-%s' % (bridge.__class__.__name__, name))
+        self.receiver_thread.daemon = True
+
+    def __repr__(self):
+        return '<%s %r>' % (self.__class__.__name__, self.name)
+
+    @property
+    def dropped(self):
+        return self.sender.dropped
+
+    def start(self):
+        self.sender.start()
+        self.receiver_thread.start()
+
+    def stop(self):
+        self.stopping = True
+        self._stop_sender()
+        self._shutdown()
+        self.receiver_thread.join()
+        self.socket.close()
+
+    def put(self, record):
+        self.sender.put(record)
+
+    def _stop_sender(self):
+        # The sender sends the records that are already queued before it stops
+        self.sender.ignore_events()
+        self.sender.stop()
+        self.sender.join()
+
+    def _shutdown(self):
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+
+    def _send_records(self, records):
+        if self.failed:
+            return  # after failing, the records are discarded until the peer is stopped
+        try:
+            self.socket.sendall(''.join(records))
+        except socket.error as e:
+            log.error('Could not send notifications to peer %r: %s' % (self.name, e))
+            self.failed = True
+            self.bridge._remove_peer(self)
+            self._shutdown()  # wake up the receiver, which will stop the sender and close the socket
+        else:
+            self.sent += len(records)
+
+    def _receive_records(self):
+        center = self.bridge.center
+        buffer = ''
+        while True:
+            try:
+                data = self.socket.recv(65536)
+            except socket.error as e:
+                if not self.stopping:
+                    log.error('Could not receive notifications from peer %r: %s' % (self.name, e))
+                break
+            if not data:
+                break
+            buffer += data
+            try:
+                notifications, offset = decode_notifications(buffer)
+            except Exception:
+                log.exception('Could not decode the notifications received from peer %r' % self.name)
+                break
+            buffer = buffer[offset:]
+            if notifications:
+                self.received += len(notifications)
+                center.post_notifications([(name, RemoteSender(self.name, sender), notification_data) for name, sender, notification_data, timestamp in notifications])
+        if not self.stopping:  # the peer disconnected or failed
+            self.bridge._remove_peer(self)
+            self._stop_sender()
+            self.socket.close()
+
+
+class NotificationBridge(object):
+    """
+    Forward notifications between the NotificationCenters of processes that
+    are connected by Unix domain sockets (for example socketpairs created
+    before forking the worker processes).
+
+    Every peer receives the notifications with the names it was added for
+    that are posted on the local center and the notifications received from
+    the peers are posted on the local center with a RemoteSender as sender.
+    The notifications received from peers are not forwarded any further.
+
+    The notifications are encoded in the posting thread, queued in a backlog
+    of up to `backlog' notifications for each peer and sent in batches of up
+    to `batch_size' notifications by a thread dedicated to each peer. When a
+    peer's backlog is full the `overflow' policy (one of Block, DropOldest or
+    DropNewest) decides what happens, with Block slowing down the posters to
+    the rate the peer can accept notifications.
+
+    The notifications are serialized using pickle, so the peers must trust
+    each other.
+    """
+
+    implements(IObserver)
+
+    def __init__(self, center=None, backlog=10000, overflow=Block, batch_size=256):
+        if overflow not in (Block, DropOldest, DropNewest):
+            raise ValueError('overflow must be one of Block, DropOldest or DropNewest')
+        self.center = center or NotificationCenter()
+        self.backlog = backlog
+        self.overflow = overflow
+        self.batch_size = batch_size
+        self.peers = []
+        self.routes = {}  # notification name -> tuple of peers
+        self.default_routes = ()  # peers that receive all notifications
+        self.lock = Lock()
+        self._peer_id = count(1)
+
+    def add_peer(self, peer, names=Any, name=None):
+        """
+        Start exchanging notifications with a peer, given as a connected Unix
+        domain socket or as the path of one to connect to. The peer receives
+        the notifications with the given names, or all notifications if names
+        is Any. Return the peer's name, which is used by the RemoteSenders of
+        the notifications received from it.
+        """
+        if isinstance(peer, basestring):
+            path, peer = peer, socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            peer.connect(path)
+        names = Any if names is Any else frozenset(names)
+        with self.lock:
+            peer = BridgePeer(self, peer, name or 'peer-%d' % next(self._peer_id), names, self.backlog, self.overflow)
+            self.peers.append(peer)
+            self._update_routes()
+        peer.start()
+        return peer.name
+
+    def stop(self):
+        """Stop forwarding notifications and disconnect from all peers, after sending the queued notifications"""
+        with self.lock:
+            peers, self.peers = self.peers, []
+            self._update_routes()
+        for peer in peers:
+            peer.stop()
+
+    def handle_notification(self, notification):
+        if isinstance(notification.sender, RemoteSender):
+            return
+        peers = self.routes.get(notification.name, self.default_routes)
+        if peers:
+            try:
+                record = encode_notification(notification)
+            except Exception:
+                log.exception('Could not encode notification %r for forwarding it to the peers' % notification.name)
+                return
+            for peer in peers:
+                peer.put(record)
+
+    def _remove_peer(self, peer):
+        with self.lock:
+            if peer in self.peers:
+                self.peers.remove(peer)
+                self._update_routes()
+
+    def _update_routes(self):
+        # Must be called with the lock held
+        default_routes = tuple(peer for peer in self.peers if peer.names is Any)
+        names = set().union(*(peer.names for peer in self.peers if peer.names is not Any))
+        routes = {name: default_routes + tuple(peer for peer in self.peers if peer.names is not Any and name in peer.names) for name in names}
+        if default_routes:
+            self.center.add_observer(self)
+        else:
+            self.center.discard_observer(self)
+        for name in names.difference(self.routes):
+            self.center.add_observer(self, name=name)
+        for name in set(self.routes).difference(names):
+            self.center.discard_observer(self, name=name)
+        self.routes = routes
+        self.default_routes = default_routes
+
@@ -2,13 +2,22 @@
 """Event processing queues, that process the events in a distinct thread"""
 
 import Queue
-from threading import Thread, Event, Lock
+import cPickle
+import mmap
+import os
+import struct
+from collections import OrderedDict, deque
+from heapq import heapify, heappop, heappush
+from itertools import count
+from math import ceil
+from threading import Thread, Condition, Event, Lock, current_thread
+from time import sleep, time
 
 from application import log
-from application.python.types import MarkerType
+from application.python.types import MarkerType, Singleton
 
 
-__all__ = 'EventQueue', 'CumulativeEventQueue'
+__all__ = 'EventQueue', 'BatchEventQueue', 'CumulativeEventQueue', 'PartitionedEventQueue', 'PriorityEventQueue', 'DurableEventQueue', 'Block', 'DropOldest', 'DropNewest', 'Raise'
 
 
 # Special events that control the queue operation (for internal use)
@@ -16,14 +25,153 @@ __all__ = 'EventQueue', 'CumulativeEventQueue'
 class StopProcessing: __metaclass__ = MarkerType
 class ProcessEvents:  __metaclass__ = MarkerType
 class DiscardEvents:  __metaclass__ = MarkerType
+class FlushEvents:    __metaclass__ = MarkerType
+
+
+# Overflow policies for the queues with a limited capacity
+
+class Block(object):
+    """Block the producer until there is room on the queue (or until the timeout expires, in which case Queue.Full is raised)"""
+    __metaclass__ = MarkerType
+
+
+class DropOldest(object):
+    """Discard the oldest event on the queue to make room"""
+    __metaclass__ = MarkerType
+
+
+class DropNewest(object):
+    """Discard the event that doesn't fit on the queue"""
+    __metaclass__ = MarkerType
+
+
+class Raise(object):
+    """Raise Queue.Full when the event doesn't fit on the queue"""
+    __metaclass__ = MarkerType
+
+
+class ScheduledEvent(object):
+    """A handle for an event that will be added on a queue at a later time"""
+
+    __slots__ = 'wheel', 'put', 'event', 'when', 'tick', '__weakref__'
+
+    def __init__(self, wheel, put, event, when):
+        self.wheel = wheel
+        self.put = put
+        self.event = event
+        self.when = when
+        self.tick = None
+
+    def cancel(self):
+        """Cancel adding the event on the queue. Returns False if it was already added (or cancelled)"""
+        return self.wheel.cancel(self)
+
+
+class TimerWheel(object):
+    """
+    A hashed timing wheel that adds the scheduled events on their queues from
+    a single thread. The events are kept in the slot of the tick (of length
+    resolution seconds) when they are due, so scheduling and cancelling an
+    event take constant time, while the thread goes through one slot every
+    tick as long as there are scheduled events.
+    """
+
+    __metaclass__ = Singleton
+
+    def __init__(self, resolution=0.01, size=4096):
+        self.resolution = resolution
+        self.size = size
+        self.slots = [set() for i in xrange(size)]
+        self.pending = 0
+        self.condition = Condition(Lock())
+        self._next_tick = None  # the next tick to go through, None while there are no scheduled events
+        self._thread = None
+
+    def schedule(self, when, put, event):
+        """Call put with the event at the given time (as returned by time.time()) and return a ScheduledEvent"""
+        scheduled_event = ScheduledEvent(self, put, event, when)
+        with self.condition:
+            if self._next_tick is None:
+                self._next_tick = int(time() / self.resolution)
+            scheduled_event.tick = max(int(ceil(when / self.resolution)), self._next_tick)
+            self.slots[scheduled_event.tick % self.size].add(scheduled_event)
+            self.pending += 1
+            if self._thread is None:
+                self._thread = Thread(target=self._run, name=self.__class__.__name__)
+                self._thread.daemon = True
+                self._thread.start()
+            elif self.pending == 1:
+                self.condition.notify()
+        return scheduled_event
+
+    def cancel(self, scheduled_event):
+        with self.condition:
+            slot = self.slots[scheduled_event.tick % self.size]
+            if scheduled_event not in slot:
+                return False
+            slot.remove(scheduled_event)
+            self.pending -= 1
+            return True
+
+    def _run(self):
+        resolution = self.resolution
+        while True:
+            with self.condition:
+                while not self.pending:
+                    self._next_tick = None
+                    self.condition.wait()
+                current_tick = int(time() / resolution)
+                expired = []
+                while self._next_tick <= current_tick:
+                    slot = self.slots[self._next_tick % self.size]
+                    if slot:
+                        due = [scheduled_event for scheduled_event in slot if scheduled_event.tick <= self._next_tick]
+                        slot.difference_update(due)
+                        self.pending -= len(due)
+                        expired.extend(due)
+                    self._next_tick += 1
+                delay = self._next_tick * resolution - time()
+            for scheduled_event in sorted(expired, key=lambda item: item.when):
+                # noinspection PyBroadException
+                try:
+                    scheduled_event.put(scheduled_event.event)
+                except Exception:
+                    log.exception('Unhandled exception while adding a scheduled event with %r' % scheduled_event.put)
+            del expired
+            if delay > 0:
+                sleep(delay)
 
 
 class EventQueue(Thread):
-    """Simple event processing queue that processes one event at a time"""
+    """
+    Simple event processing queue that processes one event at a time.
+
+    The queue holds an unlimited number of events, unless a capacity is
+    given, in which case the overflow policy (one of Block, DropOldest,
+    DropNewest or Raise) decides what happens to the events that are added
+    when the queue is full, with Block waiting for up to timeout seconds
+    (or forever if timeout is None). The dropped and blocked attributes count
+    the events that were discarded and the times a producer had to wait. The
+    preloaded events and the events that the handler adds while the queue is
+    full with the Block policy are added regardless of the capacity, as only
+    the queue's thread could make room for them.
+
+    If watermark_handler is given, it is called with True when the number of
+    events on the queue reaches high_watermark and with False when it falls
+    back to low_watermark, so the producers can slow down before the queue
+    is full.
+    """
 
-    def __init__(self, handler, name=None, preload=()):
+    def __init__(self, handler, name=None, preload=(), capacity=0, overflow=Block, timeout=None, high_watermark=None, low_watermark=None, watermark_handler=None):
         if not callable(handler):
             raise TypeError('handler should be a callable')
+        if overflow not in (Block, DropOldest, DropNewest, Raise):
+            raise ValueError('overflow should be one of Block, DropOldest, DropNewest or Raise')
+        if watermark_handler is not None:
+            if not callable(watermark_handler):
+                raise TypeError('watermark_handler should be a callable')
+            if high_watermark is None or low_watermark is None or not 0 <= low_watermark < high_watermark:
+                raise ValueError('high_watermark and low_watermark should be given, with 0 <= low_watermark < high_watermark')
         Thread.__init__(self, name=name or self.__class__.__name__)
         self.setDaemon(True)
         self._exit = Event()
@@ -31,9 +179,17 @@ class EventQueue(Thread):
         self._pause_counter = 0
         self._pause_lock = Lock()
         self._accepting_events = True
-        self.queue = Queue.Queue()
+        self._above_watermark = False
+        self.queue = self._create_queue(capacity)
+        self.overflow = overflow
+        self.timeout = timeout
+        self.high_watermark = high_watermark
+        self.low_watermark = low_watermark
+        self.watermark_handler = watermark_handler
+        self.dropped = 0
+        self.blocked = 0
         self.handle = handler
-        self.load(preload)
+        [self._put_preloaded(event) for event in preload]
         self._active.set()
 
     def run(self):
@@ -41,6 +197,8 @@ class EventQueue(Thread):
         while not self._exit.isSet():
             self._active.wait()
             event = self.queue.get()
+            if self._above_watermark:
+                self._check_low_watermark()
             if event is StopProcessing:
                 break
             # noinspection PyBroadException
@@ -55,11 +213,11 @@ class EventQueue(Thread):
         """Terminate the event processing loop/thread (force_exit=True skips processing events already on queue)"""
         if force_exit:
             self._exit.set()
-        self.queue.put(StopProcessing)
         # resume processing in case it is paused
         with self._pause_lock:
             self._pause_counter = 0
             self._active.set()
+        self._requeue(StopProcessing)
 
     def pause(self):
         """Pause processing events"""
@@ -78,8 +236,8 @@ class EventQueue(Thread):
 
     def resume(self, events=()):
         """Add events on the queue and resume processing (will unpause and enable accepting events)."""
-        [self.queue.put(event) for event in events]
-        self.unpause()
+        self.unpause()  # unpause first, as adding the events on a full queue may have to wait for room
+        [self._put(event) for event in events]
         self.accept_events()
 
     def accept_events(self):
@@ -93,12 +251,25 @@ class EventQueue(Thread):
     def put(self, event):
         """Add an event on the queue"""
         if self._accepting_events:
-            self.queue.put(event)
+            self._put(event)
 
     def load(self, events):
         """Add multiple events on the queue"""
         if self._accepting_events:
-            [self.queue.put(event) for event in events]
+            [self._put(event) for event in events]
+
+    def put_at(self, when, event):
+        """
+        Add an event on the queue at the given time (as returned by time.time()).
+        Returns a ScheduledEvent that can cancel it. The scheduled events are
+        added regardless of the capacity, unless the overflow policy drops
+        events, as the thread that adds them must not wait for room.
+        """
+        return TimerWheel().schedule(when, self._put_scheduled, event)
+
+    def put_after(self, delay, event):
+        """Add an event on the queue after delay seconds (just like put_at). Returns a ScheduledEvent that can cancel it"""
+        return TimerWheel().schedule(time() + delay, self._put_scheduled, event)
 
     def empty(self):
         """Discard all events that are present on the queue"""
@@ -108,6 +279,8 @@ class EventQueue(Thread):
                 self.queue.get_nowait()
         except Queue.Empty:
             pass
+        if self._above_watermark:
+            self._check_low_watermark()
         self.unpause()
 
     def get_unhandled(self):
@@ -128,36 +301,249 @@ class EventQueue(Thread):
     def handle(event):
         raise RuntimeError('unhandled event')
 
+    @staticmethod
+    def _create_queue(capacity):
+        return Queue.Queue(capacity)
+
+    def _put(self, event):
+        queue = self.queue
+        if not queue.maxsize and self.watermark_handler is None:
+            queue.put(event)
+            return
+        with queue.not_full:
+            if 0 < queue.maxsize <= queue._qsize():
+                if self.overflow is Block:
+                    if current_thread() is not self:  # the events added by the handler are added regardless of the capacity, as only this thread could make room for them
+                        self.blocked += 1
+                        deadline = None if self.timeout is None else time() + self.timeout
+                        while queue._qsize() >= queue.maxsize:
+                            if deadline is None:
+                                queue.not_full.wait()
+                            else:
+                                remaining = deadline - time()
+                                if remaining <= 0:
+                                    raise Queue.Full
+                                queue.not_full.wait(remaining)
+                elif self.overflow is Raise:
+                    raise Queue.Full
+                else:
+                    self.dropped += 1
+                    if self.overflow is DropNewest or not self._discard_oldest():
+                        return
+            queue._put(event)
+            queue.unfinished_tasks += 1
+            queue.not_empty.notify()
+            crossed_watermark = self.watermark_handler is not None and not self._above_watermark and queue._qsize() >= self.high_watermark
+            if crossed_watermark:
+                self._above_watermark = True
+        if crossed_watermark:
+            self._notify_watermark(True)
+
+    def _put_preloaded(self, event):
+        # The preloaded events are added regardless of the capacity, as the thread that could make room for them was not started yet
+        self._requeue(event)
+
+    def _put_scheduled(self, event):
+        # Called from the TimerWheel thread, which is shared by all the queues, so it must neither wait for room on a full queue nor raise Queue.Full
+        if self._accepting_events:
+            if self.overflow is Block or self.overflow is Raise:
+                self._requeue(event)
+            else:
+                self._put(event)
+
+    def _requeue(self, event):
+        # Add an event on the queue regardless of its capacity (used for the control events and to move events that were already accepted by another queue)
+        queue = self.queue
+        with queue.mutex:
+            queue._put(event)
+            queue.unfinished_tasks += 1
+            queue.not_empty.notify()
+
+    def _discard_oldest(self):
+        # Must be called with the queue mutex held. The control events are never discarded. Returns False if there is no event to discard
+        events = self.queue.queue
+        for index, event in enumerate(events):
+            if event is not StopProcessing and event is not ProcessEvents and event is not DiscardEvents and event is not FlushEvents:
+                del events[index]
+                return True
+        return False
+
+    def _check_low_watermark(self):
+        queue = self.queue
+        with queue.mutex:
+            crossed_watermark = self._above_watermark and queue._qsize() <= self.low_watermark
+            if crossed_watermark:
+                self._above_watermark = False
+        if crossed_watermark:
+            self._notify_watermark(False)
+
+    def _notify_watermark(self, above):
+        # noinspection PyBroadException
+        try:
+            self.watermark_handler(above)
+        except Exception:
+            log.exception('Unhandled exception in the watermark handler')
+
+
+class BatchEventQueue(EventQueue):
+    """
+    An event queue that processes the events in batches. The handler is called
+    with a list of all the events available on the queue, up to max_batch_size
+    events, which are taken from the queue in one go. If linger is not zero,
+    the queue waits for up to linger seconds after the first event of a batch
+    arrives, for more events to fill the batch.
+    """
+
+    def __init__(self, handler, name=None, preload=(), max_batch_size=1000, linger=0, **kw):
+        if max_batch_size < 1:
+            raise ValueError('max_batch_size must be a positive number')
+        if linger < 0:
+            raise ValueError('linger must be a non-negative number of seconds')
+        EventQueue.__init__(self, handler, name, preload, **kw)
+        self.max_batch_size = max_batch_size
+        self.linger = linger
+
+    def run(self):
+        """Run the event queue processing loop in its own thread"""
+        while not self._exit.isSet():
+            self._active.wait()
+            if self._exit.isSet():
+                break
+            events, stop = self._get_events()
+            if self._above_watermark:
+                self._check_low_watermark()
+            if events:
+                # noinspection PyBroadException
+                try:
+                    self.handle(events)
+                except Exception:
+                    log.exception('Unhandled exception during event handling')
+                finally:
+                    del events  # do not reference these events until the next ones arrive, in order to allow them to be released
+            if stop:
+                break
+
+    def _get_events(self):
+        # Take the available events off the queue while holding its lock only once. Returns the events and whether StopProcessing was reached
+        queue = self.queue
+        max_batch_size = self.max_batch_size
+        events = []
+        with queue.not_empty:
+            while not queue._qsize():
+                queue.not_empty.wait()
+            if self.linger:
+                deadline = time() + self.linger
+                while queue._qsize() < max_batch_size:
+                    remaining = deadline - time()
+                    if remaining <= 0:
+                        break
+                    queue.not_empty.wait(remaining)
+            stop = False
+            while len(events) < max_batch_size and queue._qsize():
+                event = queue._get()
+                if event is StopProcessing:
+                    stop = True
+                    break
+                events.append(event)
+            queue.not_full.notify(len(events) + stop)
+        return events, stop
+
+
+class BatchStatistics(object):
+    """Statistics about the batches processed by a CumulativeEventQueue: their size, the age of their oldest event and the time the handler took"""
+
+    def __init__(self, history_size=100):
+        self.lock = Lock()
+        self.history = deque(maxlen=history_size)
+        self.reset()
+
+    def record(self, size, age, handler_time):
+        with self.lock:
+            self.batches += 1
+            self.events += size
+            self.max_size = max(self.max_size, size)
+            self.total_age += age
+            self.max_age = max(self.max_age, age)
+            self.total_time += handler_time
+            self.max_time = max(self.max_time, handler_time)
+            self.history.append((time(), size, age, handler_time))
+
+    def reset(self):
+        """Discard all the collected statistics"""
+        with self.lock:
+            self.batches = 0
+            self.events = 0
+            self.max_size = 0
+            self.total_age = 0.0
+            self.max_age = 0.0
+            self.total_time = 0.0
+            self.max_time = 0.0
+            self.history.clear()
+
+    def snapshot(self):
+        """
+        Return the collected statistics as a dictionary, which includes the
+        history of the most recent batches as a list of (timestamp, size,
+        age, handler time) tuples.
+        """
+        with self.lock:
+            batches = self.batches or 1
+            return dict(batches=self.batches, events=self.events, max_size=self.max_size, average_size=float(self.events) / batches,
+                        max_age=self.max_age, average_age=self.total_age / batches, max_time=self.max_time, average_time=self.total_time / batches,
+                        history=list(self.history))
+
 
 class CumulativeEventQueue(EventQueue):
-    """An event queue that accumulates events and processes all of them together when its process method is called"""
+    """
+    An event queue that accumulates events and processes all of them together
+    when its process method is called.
+
+    The accumulated events are also processed automatically when there are
+    max_count of them, when the oldest of them is max_age seconds old or
+    when max_interval seconds passed since the previous batch, if any of
+    these limits is given. The statistics attribute is a BatchStatistics
+    instance with the size, age and handling time of the batches.
+
+    If a key function is given, an accumulated event is replaced by a newer
+    event with the same key, which takes the place of the one it replaces in
+    the batch. The replaced attribute counts the replaced events.
+    """
 
-    def __init__(self, handler, name=None, preload=()):
-        EventQueue.__init__(self, handler, name, preload)
-        self._waiting = []
+    def __init__(self, handler, name=None, preload=(), max_count=None, max_age=None, max_interval=None, key=None, **kw):
+        if max_count is not None and max_count < 1:
+            raise ValueError('max_count must be a positive number or None')
+        if key is not None and not callable(key):
+            raise TypeError('key should be a callable')
+        self.max_count = max_count
+        self.max_age = max_age
+        self.max_interval = max_interval
+        self.key = key
+        self.replaced = 0
+        self.statistics = BatchStatistics()
+        self._waiting = self._accumulate([])
+        self._oldest_time = None
+        self._last_batch_time = time()
+        self._flush_deadline = None
+        self._flush_timer = None
+        EventQueue.__init__(self, handler, name, preload, **kw)
 
     def run(self):
         """Run the event queue processing loop in its own thread"""
         while not self._exit.isSet():
             self._active.wait()
             event = self.queue.get()
+            if self._above_watermark:
+                self._check_low_watermark()
             if event is StopProcessing:
                 break
             elif event is ProcessEvents:
-                if self._waiting:
-                    preserved = []
-                    # noinspection PyBroadException
-                    try:
-                        unhandled = self.handle(self._waiting)
-                        if not isinstance(unhandled, (list, type(None))):
-                            raise ValueError('%s handler must return a list of unhandled events or None' % self.__class__.__name__)
-                        if unhandled is not None:
-                            preserved = unhandled  # preserve the unhandled events that the handler returned
-                    except Exception:
-                        log.exception('Unhandled exception during event handling')
-                    self._waiting = preserved
+                self._process_waiting()
+            elif event is FlushEvents:
+                if self._waiting and time() >= self._flush_deadline - TimerWheel().resolution:  # ignore the flushes that were triggered for the events that were already processed
+                    self._process_waiting()
             elif event is DiscardEvents:
-                self._waiting = []
+                self._waiting = self._accumulate([])
+                self._cancel_flush()
             else:
                 if getattr(event, 'high_priority', False):
                     # noinspection PyBroadException
@@ -168,20 +554,659 @@ class CumulativeEventQueue(EventQueue):
                     finally:
                         del event  # do not reference this event until the next event arrives, in order to allow it to be released
                 else:
-                    self._waiting.append(event)
+                    first_event = not self._waiting
+                    if self.key is None:
+                        self._waiting.append(event)
+                    else:
+                        key = self.key(event)
+                        if key in self._waiting:
+                            self.replaced += 1
+                        self._waiting[key] = event
+                    if first_event:
+                        self._oldest_time = time()
+                        self._schedule_flush()
+                    if self.max_count is not None and len(self._waiting) >= self.max_count:
+                        self._process_waiting()
 
     def process(self):
         """Trigger accumulated event processing. The processing is done on the queue thread"""
         if self._accepting_events:
-            self.queue.put(ProcessEvents)
+            self._requeue(ProcessEvents)
 
     def empty(self):
         """Discard any events present on the queue"""
         EventQueue.empty(self)
-        self.queue.put(DiscardEvents)
+        self._requeue(DiscardEvents)
 
     def get_unhandled(self):
         """Get unhandled events after the queue is stopped (events are removed from queue)"""
-        unhandled = self._waiting + EventQueue.get_unhandled(self)
-        self._waiting = []
-        return [e for e in unhandled if e is not ProcessEvents]
+        unhandled = self._events(self._waiting) + EventQueue.get_unhandled(self)
+        self._waiting = self._accumulate([])
+        self._cancel_flush()
+        return self._events(self._accumulate(e for e in unhandled if e is not ProcessEvents and e is not FlushEvents and e is not DiscardEvents))
+
+    def _accumulate(self, events):
+        # Return the container for the accumulated events, which maps the keys to the events when there is a key function
+        if self.key is None:
+            return list(events)
+        return OrderedDict((self.key(event), event) for event in events)
+
+    def _events(self, waiting):
+        return waiting if self.key is None else waiting.values()
+
+    def _process_waiting(self):
+        if not self._waiting:
+            return
+        self._cancel_flush()
+        events = self._events(self._waiting)
+        start_time = time()
+        preserved = []
+        # noinspection PyBroadException
+        try:
+            unhandled = self.handle(events)
+            if not isinstance(unhandled, (list, type(None))):
+                raise ValueError('%s handler must return a list of unhandled events or None' % self.__class__.__name__)
+            if unhandled is not None:
+                preserved = unhandled  # preserve the unhandled events that the handler returned
+        except Exception:
+            log.exception('Unhandled exception during event handling')
+        self._last_batch_time = time()
+        self.statistics.record(len(events), start_time - self._oldest_time, self._last_batch_time - start_time)
+        self._waiting = self._accumulate(preserved)
+        if preserved:
+            self._oldest_time = self._last_batch_time
+            self._schedule_flush()
+
+    def _schedule_flush(self):
+        deadlines = []
+        if self.max_age is not None:
+            deadlines.append(self._oldest_time + self.max_age)
+        if self.max_interval is not None:
+            deadlines.append(self._last_batch_time + self.max_interval)
+        if deadlines:
+            self._flush_deadline = min(deadlines)
+            self._flush_timer = TimerWheel().schedule(self._flush_deadline, self._requeue, FlushEvents)
+
+    def _cancel_flush(self):
+        if self._flush_timer is not None:
+            self._flush_timer.cancel()
+            self._flush_timer = None
+
+
+class EventHeap(Queue.Queue):
+    """A queue that holds (key, sequence, event) entries in a heap and returns the event of the entry with the lowest key"""
+
+    # noinspection PyAttributeOutsideInit
+    def _init(self, maxsize):
+        self.queue = []
+        self.sequence = count()
+        self.stopped = False
+
+    def _qsize(self, len=len):
+        return len(self.queue)
+
+    def _put(self, entry):
+        if entry is StopProcessing:  # the stop marker is added by the EventQueue itself, unwrapped
+            self.stopped = True
+            entry = float('inf'), next(self.sequence), entry
+        elif self.stopped:  # the events added after the stop marker come after it, regardless of their priority
+            entry = float('inf'), entry[1], entry[2]
+        heappush(self.queue, entry)
+
+    def _get(self):
+        return heappop(self.queue)[2]
+
+
+class PriorityEventQueue(EventQueue):
+    """
+    An event queue that processes the events with a higher priority first
+    and the events with the same priority in the order they were added. The
+    priority is an integer given when adding the events (0 by default).
+
+    If aging is not zero, the priority of the events waiting on the queue
+    grows by aging every second, so the events with a low priority are not
+    delayed indefinitely by a stream of events with a higher priority. As
+    all the waiting events age at the same rate, the order between them is
+    fixed when they are added, which keeps adding and taking events off the
+    queue logarithmic in the number of waiting events.
+    """
+
+    def __init__(self, handler, name=None, preload=(), aging=0, **kw):
+        if aging < 0:
+            raise ValueError('aging must be a non-negative number')
+        self.aging = aging
+        self._epoch = time()
+        EventQueue.__init__(self, handler, name, preload, **kw)
+
+    def put(self, event, priority=0):
+        """Add an event on the queue with the given priority"""
+        if self._accepting_events:
+            self._put(event, priority)
+
+    def load(self, events, priority=0):
+        """Add multiple events on the queue with the given priority"""
+        if self._accepting_events:
+            [self._put(event, priority) for event in events]
+
+    @staticmethod
+    def _create_queue(capacity):
+        return EventHeap(capacity)
+
+    def _put(self, event, priority=0):
+        EventQueue._put(self, self._entry(event, priority))
+
+    def _put_preloaded(self, event):
+        self._requeue(self._entry(event, 0))
+
+    def _put_scheduled(self, event):
+        if self._accepting_events:
+            if self.overflow is Block or self.overflow is Raise:
+                self._requeue(self._entry(event, 0))
+            else:
+                self._put(event)
+
+    def _entry(self, event, priority):
+        # The event with the highest priority, after aging, comes first: priority + (now - added) * aging is ordered as priority - added * aging
+        key = (time() - self._epoch) * self.aging - priority if self.aging else -priority
+        return key, next(self.queue.sequence), event
+
+    def _discard_oldest(self):
+        # Must be called with the queue mutex held
+        entries = self.queue.queue
+        candidates = [entry for entry in entries if entry[2] is not StopProcessing]
+        if not candidates:
+            return False
+        entries.remove(min(candidates, key=lambda entry: entry[1]))
+        heapify(entries)
+        return True
+
+
+class SegmentQueue(Queue.Queue):
+    """
+    A queue that keeps up to memory_limit events in memory and writes the
+    rest to append-only segment files in a directory, which are read back
+    through mmap, in order, once the events before them were taken off the
+    queue. The segments are deleted after all their events were read.
+    The StopProcessing markers are never written to disk, so they are not
+    loaded again by the next queue that uses the directory.
+    """
+
+    segment_base = 1 << 32  # the number of the first segment, which leaves room for the segments that are added in front of it when saving the queue
+
+    _header = struct.Struct('!I')
+    _stop_record = cPickle.dumps(StopProcessing, cPickle.HIGHEST_PROTOCOL)  # the marker as written by the earlier versions, which is skipped when reading
+
+    def __init__(self, directory, memory_limit, segment_size, maxsize=0):
+        self.directory = directory
+        self.memory_limit = memory_limit
+        self.segment_size = segment_size
+        Queue.Queue.__init__(self, maxsize)
+
+    # noinspection PyAttributeOutsideInit
+    def _init(self, maxsize):
+        self.queue = deque()  # the events in memory, which come before the ones on disk
+        self.spilled = 0  # the number of events on disk
+        self.segments = deque()  # the numbers of the segment files, in order
+        self.start_offsets = {}  # segment number -> offset of the first event that was not read yet, for the partially read segments
+        self.markers = deque()  # (position, marker) for the markers added after the events on disk, position being the number of events written to disk before them
+        self._written = 0  # the number of events written to disk (including the ones that were loaded)
+        self._read_count = 0  # the number of events read from disk
+        self._writer = None
+        self._writer_segment = None
+        self._writer_size = 0
+        self._reader = None
+        self._reader_segment = None
+        self._reader_offset = 0
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        self._load()
+        self._written = self.spilled
+
+    def _qsize(self, len=len):
+        return len(self.queue) + self.spilled + len(self.markers)
+
+    def _put(self, event):
+        if self.spilled or self.markers or len(self.queue) >= self.memory_limit:
+            if event is StopProcessing:
+                self.markers.append((self._written, event))
+            else:
+                self._write(event)
+        else:
+            self.queue.append(event)
+
+    def _get(self):
+        if not self.queue:
+            self._read(max(1, self.memory_limit // 2))
+        return self.queue.popleft()
+
+    def put_first(self, event):
+        """Add an event in front of all the others, regardless of the capacity"""
+        with self.mutex:
+            self.queue.appendleft(event)
+            self.unfinished_tasks += 1
+            self.not_empty.notify()
+
+    def save(self):
+        """Move the events in memory to disk and record the position of the first event that was not read from each segment, so they are all loaded the next time"""
+        with self.mutex:
+            events = [event for event in self.queue if event is not StopProcessing]
+            self.queue.clear()
+            self.markers.clear()
+            self._close_reader()
+            self._close_writer()
+            if events:
+                number = self.segments[0] - 1 if self.segments else self.segment_base
+                with open(self._segment_path(number), 'wb') as segment:
+                    segment.write(''.join(self._encode(event) for event in events))
+                self.segments.appendleft(number)
+                self.spilled += len(events)
+                self._written += len(events)
+            position_path = os.path.join(self.directory, 'position')
+            if self.start_offsets:
+                with open(position_path + '.tmp', 'w') as position_file:
+                    position_file.write(''.join('%d %d\n' % item for item in self.start_offsets.iteritems()))
+                os.rename(position_path + '.tmp', position_path)
+            elif os.path.exists(position_path):
+                os.unlink(position_path)
+
+    def _encode(self, event):
+        data = cPickle.dumps(event, cPickle.HIGHEST_PROTOCOL)
+        return self._header.pack(len(data)) + data
+
+    def _segment_path(self, number):
+        return os.path.join(self.directory, 'segment-%020d' % number)
+
+    def _load(self):
+        self.segments.extend(sorted(int(name[8:]) for name in os.listdir(self.directory) if name.startswith('segment-')))
+        try:
+            with open(os.path.join(self.directory, 'position')) as position_file:
+                for line in position_file:
+                    number, offset = map(int, line.split())
+                    if number in self.segments:
+                        self.start_offsets[number] = offset
+        except IOError:
+            pass
+        header_size = self._header.size
+        for number in self.segments:
+            with open(self._segment_path(number), 'r+b') as segment:
+                size = os.fstat(segment.fileno()).st_size
+                offset = self.start_offsets.get(number, 0)
+                while offset + header_size <= size:
+                    segment.seek(offset)
+                    length, = self._header.unpack(segment.read(header_size))
+                    if offset + header_size + length > size:
+                        break
+                    offset += header_size + length
+                    if length != len(self._stop_record) or segment.read(length) != self._stop_record:
+                        self.spilled += 1
+                if offset < size:
+                    segment.truncate(offset)  # drop the incomplete record of a write that was interrupted
+
+    def _write(self, event):
+        if self._writer is not None and self._writer_size >= self.segment_size:
+            self._close_writer()
+        if self._writer is None:
+            if self.segments and os.path.getsize(self._segment_path(self.segments[-1])) < self.segment_size:
+                number = self.segments[-1]
+            else:
+                number = self.segments[-1] + 1 if self.segments else self.segment_base
+                self.segments.append(number)
+            self._writer = open(self._segment_path(number), 'ab')
+            self._writer_segment = number
+            self._writer_size = os.path.getsize(self._segment_path(number))
+        record = self._encode(event)
+        self._writer.write(record)
+        self._writer_size += len(record)
+        self.spilled += 1
+        self._written += 1
+
+    def _read(self, count):
+        header_size = self._header.size
+        events = []
+        while len(events) < count and self.spilled:
+            if self.markers and self.markers[0][0] <= self._read_count:
+                events.append(self.markers.popleft()[1])
+                continue
+            if self._reader_segment is None:
+                self._reader_segment = self.segments[0]
+                self._reader_offset = self.start_offsets.pop(self._reader_segment, 0)
+                self._reader = self._map(self._reader_segment)
+            reader = self._reader
+            offset = self._reader_offset
+            if reader is None or offset + header_size > len(reader):
+                mapped_size = len(reader) if reader is not None else 0
+                if self._reader_segment == self._writer_segment or os.path.getsize(self._segment_path(self._reader_segment)) > mapped_size:  # the segment grew since it was mapped
+                    if reader is not None:
+                        reader.close()
+                    self._reader = self._map(self._reader_segment)
+                else:
+                    self._reader_offset = 0  # the segment was read completely
+                    self._close_reader()
+                    os.unlink(self._segment_path(self.segments.popleft()))
+                continue
+            length, = self._header.unpack_from(reader, offset)
+            record = reader[offset+header_size:offset+header_size+length]
+            self._reader_offset = offset + header_size + length
+            if record == self._stop_record:
+                continue
+            events.append(cPickle.loads(record))
+            self._read_count += 1
+            self.spilled -= 1
+        if not self.spilled:
+            events.extend(marker for position, marker in self.markers)
+            self.markers.clear()
+            self._reader_offset = 0
+            self._close_reader()
+            self._close_writer()
+            while self.segments:
+                os.unlink(self._segment_path(self.segments.popleft()))
+            if os.path.exists(os.path.join(self.directory, 'position')):
+                os.unlink(os.path.join(self.directory, 'position'))
+        self.queue.extend(events)
+
+    def _map(self, number):
+        if number == self._writer_segment:
+            self._writer.flush()
+        with open(self._segment_path(number), 'rb') as segment:
+            size = os.fstat(segment.fileno()).st_size
+            return mmap.mmap(segment.fileno(), size, access=mmap.ACCESS_READ) if size else None
+
+    def _close_reader(self):
+        if self._reader_offset:
+            self.start_offsets[self._reader_segment] = self._reader_offset
+        if self._reader is not None:
+            self._reader.close()
+        self._reader = self._reader_segment = None
+        self._reader_offset = 0
+
+    def _close_writer(self):
+        if self._writer is not None:
+            self._writer.close()
+        self._writer = self._writer_segment = None
+        self._writer_size = 0
+
+
+class DurableEventQueue(EventQueue):
+    """
+    An event queue that keeps up to memory_limit events in memory and spills
+    the rest to append-only segment files (of about segment_size bytes) in
+    the given directory, reading them back in order through mmap. The events
+    must be picklable.
+
+    When the queue stops, the events that were not processed are saved in
+    the directory and they are loaded again by the next DurableEventQueue
+    that uses it, ahead of any new events. The segments are not synced to
+    disk, so they survive the process, but not the system crashing, and if
+    the process crashes the events that were already read from the segment
+    being read may be processed again.
+    """
+
+    def __init__(self, handler, directory, name=None, preload=(), memory_limit=10000, segment_size=64*1024*1024, **kw):
+        if memory_limit < 1:
+            raise ValueError('memory_limit must be a positive number')
+        self.directory = directory
+        self.memory_limit = memory_limit
+        self.segment_size = segment_size
+        EventQueue.__init__(self, handler, name, preload, **kw)
+
+    def run(self):
+        """Run the event queue processing loop in its own thread and save the unprocessed events when it ends"""
+        try:
+            EventQueue.run(self)
+        finally:
+            self.queue.save()
+
+    def stop(self, force_exit=False):
+        """Terminate the event processing loop/thread (force_exit=True skips processing events already on queue, leaving them saved on disk)"""
+        if not force_exit:
+            EventQueue.stop(self)
+            return
+        self._exit.set()
+        with self._pause_lock:
+            self._pause_counter = 0
+            self._active.set()
+        self.queue.put_first(StopProcessing)  # only wakes up the processing loop, so it doesn't have to wait for the events before it, which may be on disk
+
+    def get_unhandled(self):
+        """Get unhandled events after the queue is stopped (events are removed from queue and from disk)"""
+        unhandled = EventQueue.get_unhandled(self)
+        self.queue.save()
+        return unhandled
+
+    def _create_queue(self, capacity):
+        return SegmentQueue(self.directory, self.memory_limit, self.segment_size, capacity)
+
+
+class PartitionedEventQueue(object):
+    """
+    An event queue that processes the events with multiple worker threads.
+    The events are assigned to the workers by the hash of the key returned
+    by the key function for them, so the events with the same key are
+    processed one at a time in the order they were added, while the events
+    with different keys can be processed concurrently.
+
+    Each worker is an EventQueue and the extra keyword arguments (capacity,
+    overflow, ...) are used to create them. Changing the number of workers
+    moves the events that were not processed yet to the new workers, which
+    start processing after the old workers finish the events they already
+    started processing, so the order of the events with the same key is
+    preserved. The producers wait while the workers are being changed.
+
+    The events that the handler adds from the worker threads are always
+    added, regardless of the capacity of the workers, as waiting for room
+    on a full worker could deadlock the worker threads.
+    """
+
+    def __init__(self, handler, key, workers=4, name=None, preload=(), **kw):
+        if not callable(handler):
+            raise TypeError('handler should be a callable')
+        if not callable(key):
+            raise TypeError('key should be a callable')
+        if workers < 1:
+            raise ValueError('workers should be a positive number')
+        self.name = name or self.__class__.__name__
+        self.handle = handler
+        self.key = key
+        self._worker_options = kw
+        self._lock = Lock()
+        self._resized = Condition(self._lock)
+        self._pause_counter = 0
+        self._accepting_events = True
+        self._started = False
+        self._stopped = False
+        self._force_exit = False
+        self._resizing = False
+        self._adding = 0  # the producers that are adding an event on a worker, outside of the lock
+        self._workers = self._create_workers(workers)
+        self._old_workers = ()  # the workers that are being replaced by resize
+        for event in preload:
+            self._get_worker(event)._put_preloaded(event)
+
+    @property
+    def workers(self):
+        return len(self._workers)
+
+    def start(self):
+        """Start the worker threads"""
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+            for worker in self._workers:
+                worker.start()
+
+    def stop(self, force_exit=False):
+        """Terminate the worker threads (force_exit=True skips processing events already on queue)"""
+        with self._lock:
+            self._stopped = True
+            self._force_exit = self._force_exit or force_exit
+            self._pause_counter = 0
+            for worker in self._workers:
+                worker.stop(force_exit)
+
+    def join(self, timeout=None):
+        for worker in self._workers:
+            worker.join(timeout)
+
+    def isAlive(self):
+        return any(worker.isAlive() for worker in self._workers)
+
+    is_alive = isAlive
+
+    def pause(self):
+        """Pause processing events"""
+        with self._lock:
+            self._pause_counter += 1
+            for worker in self._workers:
+                worker.pause()
+
+    def unpause(self):
+        """Resume processing events"""
+        with self._lock:
+            if self._pause_counter == 0:
+                return  # already active
+            self._pause_counter -= 1
+            for worker in self._workers:
+                worker.unpause()
+
+    def resume(self, events=()):
+        """Add events on the queue and resume processing (will unpause and enable accepting events)."""
+        self.unpause()  # unpause first, as adding the events on a full queue may have to wait for room
+        [self._put(event) for event in events]
+        self.accept_events()
+
+    def accept_events(self):
+        """Accept events for processing"""
+        self._accepting_events = True
+
+    def ignore_events(self):
+        """Ignore events for processing"""
+        self._accepting_events = False
+
+    def put(self, event):
+        """Add an event on the queue"""
+        if self._accepting_events:
+            self._put(event)
+
+    def load(self, events):
+        """Add multiple events on the queue"""
+        if self._accepting_events:
+            [self._put(event) for event in events]
+
+    def put_at(self, when, event):
+        """Add an event on the queue at the given time (as returned by time.time()), like EventQueue.put_at. Returns a ScheduledEvent that can cancel it"""
+        return TimerWheel().schedule(when, self._put_scheduled, event)
+
+    def put_after(self, delay, event):
+        """Add an event on the queue after delay seconds, like EventQueue.put_after. Returns a ScheduledEvent that can cancel it"""
+        return TimerWheel().schedule(time() + delay, self._put_scheduled, event)
+
+    def empty(self):
+        """Discard all events that are present on the queue"""
+        with self._lock:
+            for worker in self._workers:
+                worker.empty()
+
+    def get_unhandled(self):
+        """Get unhandled events after the queue is stopped (events are removed from queue)"""
+        if self.isAlive():
+            raise RuntimeError('Queue is still running')
+        unhandled = []
+        for worker in self._workers:
+            unhandled.extend(worker.get_unhandled())
+        return unhandled
+
+    def resize(self, workers):
+        """Change the number of worker threads, moving the events that were not processed yet to the new workers (the queue must not be stopped)"""
+        if workers < 1:
+            raise ValueError('workers should be a positive number')
+        with self._lock:
+            while self._resizing:
+                self._resized.wait()
+            if self._stopped:
+                raise RuntimeError('Queue is stopped')
+            if workers == len(self._workers):
+                return
+            self._resizing = True
+            old_workers = self._old_workers = self._workers
+        try:
+            with self._lock:
+                for worker in old_workers:
+                    worker.pause()
+            events = []
+            while True:
+                # taking the events off the old workers makes room for the producers that are waiting to add events on them
+                self._take_events(old_workers, events)
+                with self._lock:
+                    if not self._adding:
+                        self._take_events(old_workers, events)
+                        self._workers = self._create_workers(workers)
+                        for event in events:
+                            self._get_worker(event)._requeue(event)
+                        if self._stopped:  # stopped while the events were taken off the old workers
+                            for worker in self._workers:
+                                worker.stop(self._force_exit)
+                        started = self._started
+                        break
+                    self._resized.wait(0.01)
+            if started:
+                for worker in old_workers:
+                    worker.stop()
+                for worker in old_workers:
+                    worker.join()
+                for worker in self._workers:
+                    worker.start()
+        finally:
+            with self._lock:
+                self._resizing = False
+                self._old_workers = ()
+                self._resized.notify_all()
+
+    def _create_workers(self, count):
+        # Must be called with the lock held (or from __init__)
+        workers = [EventQueue(self.handle, name='%s-%d' % (self.name, index), **self._worker_options) for index in xrange(count)]
+        for worker in workers:
+            for i in xrange(self._pause_counter):
+                worker.pause()
+        return workers
+
+    def _get_worker(self, event):
+        # Must be called with the lock held
+        workers = self._workers
+        return workers[hash(self.key(event)) % len(workers)]
+
+    def _put(self, event):
+        # Must be called without holding the lock, as adding the event may wait for room on a full worker
+        thread = current_thread()
+        with self._lock:
+            if thread.__class__ is EventQueue and (thread in self._workers or thread in self._old_workers):  # added by the handler
+                self._get_worker(event)._requeue(event)
+                return
+            while self._resizing:
+                self._resized.wait()
+            worker = self._get_worker(event)
+            self._adding += 1
+        try:
+            worker._put(event)
+        finally:
+            with self._lock:
+                self._adding -= 1
+                if self._resizing and not self._adding:
+                    self._resized.notify_all()
+
+    def _put_scheduled(self, event):
+        if self._accepting_events:
+            with self._lock:
+                self._get_worker(event)._put_scheduled(event)  # it doesn't wait for room, so it can be called with the lock held
+
+    @staticmethod
+    def _take_events(workers, events):
+        # The StopProcessing markers are left out, as the new workers are stopped separately if the queue was stopped
+        for worker in workers:
+            try:
+                while True:
+                    event = worker.queue.get_nowait()
+                    if event is not StopProcessing:
+                        events.append(event)
+            except Queue.Empty:
+                pass
@@ -0,0 +1,50 @@
+#!/usr/bin/python2
+
+"""Measure the throughput of an event queue that spills its backlog to disk"""
+
+import shutil
+import tempfile
+
+from threading import Event
+from time import time
+
+from application.python.queue import EventQueue, DurableEventQueue
+
+
+class Consumer(object):
+    def __init__(self, expected):
+        self.expected = expected
+        self.count = 0
+        self.done = Event()
+
+    def __call__(self, event):
+        self.count += 1
+        if self.count == self.expected:
+            self.done.set()
+
+
+def run(description, create_queue, event_count=200000):
+    consumer = Consumer(event_count)
+    queue = create_queue(consumer)
+    queue.start()
+    event = dict(id=0, state='active', payload='x' * 100)
+    start_time = time()
+    for index in xrange(event_count):
+        queue.put(dict(event, id=index))
+    put_time = time() - start_time
+    consumer.done.wait()
+    elapsed = time() - start_time
+    queue.stop()
+    queue.join()
+    print '%-40s %8d events/s added %8d events/s processed' % (description, event_count/put_time, event_count/elapsed)
+
+
+directory = tempfile.mkdtemp()
+
+print "Event queue throughput"
+print "----------------------"
+run('in memory', EventQueue)
+for memory_limit in (100000, 10000, 1000):
+    run('spilling past %d events' % memory_limit, lambda handler: DurableEventQueue(handler, directory, memory_limit=memory_limit))
+
+shutil.rmtree(directory)
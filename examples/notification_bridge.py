@@ -0,0 +1,64 @@
+#!/usr/bin/python2
+
+"""Measure the throughput of forwarding notifications between two processes"""
+
+import os
+import socket
+
+from threading import Event
+from time import time
+from zope.interface import implements
+
+from application.notification import IObserver, NotificationCenter, NotificationData
+from application.notification_bridge import NotificationBridge
+
+
+class CountingObserver(object):
+    implements(IObserver)
+
+    def __init__(self, expected):
+        self.expected = expected
+        self.count = 0
+        self.done = Event()
+
+    def handle_notification(self, notification):
+        self.count += 1
+        if self.count == self.expected:
+            self.done.set()
+
+
+def run(notification_count, batch_size):
+    parent_socket, child_socket = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+    pid = os.fork()
+    if pid == 0:
+        parent_socket.close()
+        center = NotificationCenter()
+        observer = CountingObserver(notification_count)
+        center.add_observer(observer, name='WorkerNotification')
+        bridge = NotificationBridge(center, batch_size=batch_size)
+        bridge.add_peer(child_socket, names=['WorkerDone'])
+        observer.done.wait()
+        center.post_notification('WorkerDone', sender='worker', data=NotificationData(count=observer.count))
+        bridge.stop()
+        os._exit(0)
+    child_socket.close()
+    center = NotificationCenter()
+    observer = CountingObserver(1)
+    center.add_observer(observer, name='WorkerDone')
+    bridge = NotificationBridge(center, batch_size=batch_size)
+    bridge.add_peer(parent_socket, names=['WorkerNotification'])
+    post_notification = center.post_notification
+    start_time = time()
+    for index in xrange(notification_count):
+        post_notification('WorkerNotification', sender='master', data=NotificationData(index=index))
+    observer.done.wait()
+    elapsed = time() - start_time
+    bridge.stop()
+    os.waitpid(pid, 0)
+    print 'batches of %4d notifications: %8d notifications/s' % (batch_size, notification_count/elapsed)
+
+
+print "Forwarding notifications to another process"
+print "-------------------------------------------"
+for size in (1, 16, 256, 1024):
+    run(100000, size)
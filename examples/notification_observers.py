@@ -0,0 +1,48 @@
+#!/usr/bin/python2
+
+"""Compare the cost of delivering notifications to the different kinds of observers"""
+
+from time import time
+from zope.interface import implements
+
+from application.notification import IObserver, NotificationCenter, ObserverWeakrefProxy
+
+
+class Observer(object):
+    implements(IObserver)
+
+    def handle_notification(self, notification):
+        pass
+
+
+class Subscriber(object):
+    def handle_account_notification(self, notification):
+        pass
+
+
+def handle_notification(notification):
+    pass
+
+
+def measure(description, observer, count=200000, **options):
+    center = NotificationCenter('benchmark')
+    center.add_observer(observer, name='BenchmarkNotification', **options)
+    post_notification = center.post_notification
+    start_time = time()
+    for i in xrange(count):
+        post_notification('BenchmarkNotification')
+    elapsed = time() - start_time
+    center.remove_observer(observer, name='BenchmarkNotification')
+    print '%-25s %8.3f us/notification' % (description, elapsed / count * 1e6)
+
+
+observer = Observer()
+subscriber = Subscriber()
+
+print "Notification delivery cost by observer type"
+print "-------------------------------------------"
+measure('IObserver', observer)
+measure('ObserverWeakrefProxy', ObserverWeakrefProxy(observer))
+measure('function', handle_notification)
+measure('bound method (weak)', subscriber.handle_account_notification)  # not faster than IObserver, as it dereferences the object on every call
+measure('bound method (strong)', subscriber.handle_account_notification, weak=False)
@@ -0,0 +1,59 @@
+#!/usr/bin/python2
+
+"""Record the notifications posted by an application and replay them to benchmark the observers"""
+
+import os
+import tempfile
+
+from time import sleep
+from zope.interface import implements
+
+from application.debug.notification import NotificationRecorder, NotificationReplayer
+from application.notification import IObserver, NotificationCenter, NotificationData
+
+
+class Account(object):
+    def __init__(self, id):
+        self.id = id
+
+
+class AccountObserver(object):
+    implements(IObserver)
+
+    def handle_notification(self, notification):
+        pass
+
+
+class SlowAccountObserver(object):
+    implements(IObserver)
+
+    def handle_notification(self, notification):
+        sleep(0.0001)
+
+
+center = NotificationCenter()
+recording = os.path.join(tempfile.gettempdir(), 'notification_replay.log')
+
+# Record the notifications posted while the application runs
+recorder = NotificationRecorder(recording)
+recorder.start()
+accounts = [Account(index) for index in range(10)]
+for index in xrange(20000):
+    account = accounts[index % len(accounts)]
+    center.post_notification('AccountDidChangeState', sender=account.id, data=NotificationData(state='active' if index % 3 else 'inactive'))
+    if index % 100 == 0:
+        center.post_notification('AccountDidReceiveMessage', sender=account.id, data=NotificationData(size=index % 1000))
+        sleep(0.001)
+recorder.stop()
+print 'Recorded %d notifications in %s (%d bytes)' % (recorder.count, recording, os.path.getsize(recording))
+
+# Replay them on a center with the observers to benchmark
+center.add_observer(AccountObserver(), name='AccountDidChangeState')
+center.add_observer(SlowAccountObserver(), name='AccountDidReceiveMessage')
+replayer = NotificationReplayer(recording)
+print 'Replaying as fast as possible:'
+print replayer.replay()
+print 'Replaying with the original timing:'
+print replayer.replay(speed=1.0)
+
+os.unlink(recording)
@@ -0,0 +1,96 @@
+#!/usr/bin/python2
+
+"""Stress test for posting notifications from multiple threads while the subscriptions change"""
+
+from itertools import count
+from threading import Event, Thread
+from time import sleep, time
+from zope.interface import implements
+
+from application.notification import IObserver, NotificationCenter
+
+
+class CountingObserver(object):
+    implements(IObserver)
+
+    def __init__(self):
+        self.count = 0
+
+    def handle_notification(self, notification):
+        self.count += 1
+
+
+class Sender(object):
+    def __init__(self, index):
+        self.index = index
+
+    def __repr__(self):
+        return '%s(%d)' % (self.__class__.__name__, self.index)
+
+
+names = ['Notification%d' % index for index in range(20)]
+senders = [Sender(index) for index in range(100)]
+
+center = NotificationCenter('stress')
+permanent_observer = CountingObserver()
+for notification_name in names:
+    center.add_observer(permanent_observer, name=notification_name)
+
+
+def poster(stop_event, results, index):
+    post_notification = center.post_notification
+    posts = 0
+    errors = 0
+    while not stop_event.is_set():
+        for sender in senders:
+            for notification_name in names:
+                try:
+                    post_notification(notification_name, sender)
+                except Exception:
+                    errors += 1
+            posts += len(names)
+    results[index] = posts, errors
+
+
+def churner(stop_event, results, index):
+    changes = 0
+    observer = CountingObserver()
+    for i in count():
+        if stop_event.is_set():
+            break
+        sender = senders[i % len(senders)]
+        notification_name = names[i % len(names)]
+        center.add_observer(observer, name=notification_name, sender=sender)
+        center.add_observer(observer, sender=sender)
+        center.remove_observer(observer, name=notification_name, sender=sender)
+        center.remove_observer(observer, sender=sender)
+        changes += 4
+    results[index] = changes
+
+
+def run(poster_count, churner_count, duration=2.0):
+    stop_event = Event()
+    post_results = {}
+    churn_results = {}
+    threads = [Thread(target=poster, args=(stop_event, post_results, index)) for index in range(poster_count)]
+    threads.extend(Thread(target=churner, args=(stop_event, churn_results, index)) for index in range(churner_count))
+    start_time = time()
+    for thread in threads:
+        thread.start()
+    sleep(duration)
+    stop_event.set()
+    for thread in threads:
+        thread.join()
+    elapsed = time() - start_time
+    posts = sum(posts for posts, errors in post_results.itervalues())
+    errors = sum(errors for posts, errors in post_results.itervalues())
+    changes = sum(churn_results.itervalues())
+    print '%2d posting threads, %d churning threads: %9d posts/s %8d subscription changes/s %d errors' % (poster_count, churner_count, posts/elapsed, changes/elapsed, errors)
+
+
+print "Posting notifications while other threads add and remove subscriptions"
+print "-----------------------------------------------------------------------"
+for thread_count in (1, 2, 4, 8):
+    run(thread_count, churner_count=0)
+for thread_count in (1, 2, 4, 8):
+    run(thread_count, churner_count=2)
@@ -0,0 +1,153 @@
+
+import socket
+import unittest
+
+from threading import Thread
+
+from application.notification import NotificationCenter, NotificationData, NotificationDispatcher, NotificationStatistics, EventLoopDispatcher, Notification, Coalesce
+from application.notification_bridge import NotificationBridge
+from application.python.queue import DropOldest
+
+
+class NotificationBatchTest(unittest.TestCase):
+    def setUp(self):
+        self.center = NotificationCenter(self.id())
+        self.received = []
+
+    def test_nested_notifications_are_delivered_between_the_batch_notifications(self):
+        def handler(notification):
+            self.received.append(notification.name)
+            if notification.name == 'A1':
+                self.center.post_notification('Nested')
+        for name in ('A1', 'A2', 'Nested'):
+            self.center.add_observer(handler, name=name)
+        self.center.post_notifications([('A1', None, NotificationData()), ('A2', None, NotificationData())])
+        self.assertEqual(self.received, ['A1', 'Nested', 'A2'])
+
+    def test_coalescing_in_a_batch(self):
+        self.center.add_observer(lambda notification: self.received.append(notification.data.index), name='C', coalesce=Coalesce())
+        self.center.post_notifications([('C', None, NotificationData(index=index)) for index in range(5)])
+        self.assertEqual(self.received, [4])
+        self.assertEqual(self.center.coalesced_notifications, 4)
+
+    def test_coalescing_the_notifications_posted_by_a_batch(self):
+        def handler(notification):
+            self.received.append(notification.name)
+            self.center.post_notification('C', data=NotificationData(index=notification.data.index))
+        self.center.add_observer(handler, name='A')
+        self.center.add_observer(lambda notification: self.received.append(notification.data.index), name='C', coalesce=Coalesce(merge=True))
+        self.center.post_notifications([('A', None, NotificationData(index=index)) for index in range(3)])
+        self.assertEqual(self.received, ['A', 'A', 'A', 2])
+        self.assertEqual(self.center.coalesced_notifications, 2)
+
+
+class Subscriber(object):
+    def __init__(self):
+        self.received = []
+
+    def handle_test_notification(self, notification):
+        self.received.append(notification.name)
+
+
+class MethodObserverTest(unittest.TestCase):
+    def setUp(self):
+        self.center = NotificationCenter(self.id())
+
+    def test_strong_method_observer(self):
+        subscriber = Subscriber()
+        self.center.add_observer(subscriber.handle_test_notification, name='Test', weak=False)
+        self.center.post_notification('Test')
+        self.center.remove_observer(subscriber.handle_test_notification, name='Test')
+        self.center.post_notification('Test')
+        self.assertEqual(subscriber.received, ['Test'])
+        self.assertFalse(self.center.has_observers('Test'))
+
+    def test_weak_and_strong_method_observers(self):
+        subscriber = Subscriber()
+        self.center.add_observer(subscriber.handle_test_notification, name='Weak')
+        self.center.add_observer(subscriber.handle_test_notification, name='Strong', weak=False)
+        self.center.remove_observer(subscriber.handle_test_notification, name='Weak')
+        self.center.post_notification('Weak')
+        self.center.post_notification('Strong')
+        self.assertEqual(subscriber.received, ['Strong'])
+        self.assertRaises(KeyError, self.center.remove_observer, subscriber.handle_test_notification, name='Weak')
+
+    def test_purge_weak_and_strong_method_observers(self):
+        subscriber = Subscriber()
+        self.center.add_observer(subscriber.handle_test_notification, name='Weak')
+        self.center.add_observer(subscriber.handle_test_notification, name='Strong', weak=False)
+        self.center.purge_observer(subscriber.handle_test_notification)
+        self.assertFalse(self.center.has_observers('Weak'))
+        self.assertFalse(self.center.has_observers('Strong'))
+
+class NamedObserver(object):
+    def __repr__(self):
+        return 'NamedObserver()'
+
+    def __call__(self, notification):
+        pass
+
+
+class NotificationStatisticsTest(unittest.TestCase):
+    def test_observers_with_the_same_representation(self):
+        center = NotificationCenter(self.id())
+        center.statistics = NotificationStatistics()
+        observers = [NamedObserver(), NamedObserver()]
+        for observer in observers:
+            center.add_observer(observer, name='Test')
+        center.post_notification('Test')
+        statistics = center.statistics.snapshot()['observers']
+        self.assertEqual(len(statistics), 2)
+        self.assertEqual([statistics[NotificationStatistics.label(observer)]['count'] for observer in observers], [1, 1])
+
+
+class NotificationDispatcherTest(unittest.TestCase):
+    def test_flush_with_drop_oldest(self):
+        dispatcher = NotificationDispatcher(backlog=2, overflow=DropOldest)
+        dispatcher.pause()  # before starting it, so the thread doesn't take the flush marker
+        dispatcher.start()
+        results = []
+        flusher = Thread(target=lambda: results.append(dispatcher.flush(timeout=5)))
+        flusher.start()
+        while not dispatcher.queue.qsize():
+            flusher.join(0.001)
+        for index in range(10):
+            dispatcher.put((None, lambda notification: None, Notification('Test')))  # overflows the backlog, but must not drop the flush marker
+        dispatcher.unpause()
+        flusher.join()
+        dispatcher.stop()
+        self.assertEqual(results, [True])
+        self.assertEqual(dispatcher.dropped, 9)
+
+
+class ClosedLoop(object):
+    def call_soon_threadsafe(self, callback):
+        raise RuntimeError('Event loop is closed')
+
+
+class EventLoopDispatcherTest(unittest.TestCase):
+    def test_put_on_closed_loop(self):
+        loop = ClosedLoop()
+        dispatcher = EventLoopDispatcher(loop)
+        for index in range(3):
+            dispatcher.put((None, lambda notification: None, Notification('Test')))
+        self.assertEqual(dispatcher.pending, [])
+
+
+class NotificationBridgeTest(unittest.TestCase):
+    def test_stop_with_drop_oldest(self):
+        local_socket, remote_socket = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+        bridge = NotificationBridge(NotificationCenter(self.id()), backlog=2, overflow=DropOldest)
+        bridge.add_peer(local_socket, names=['Test'])
+        peer = bridge.peers[0]
+        peer.sender.pause()  # the sender may have already taken the first notification
+        for index in range(10):
+            bridge.center.post_notification('Test', data=NotificationData(index=index))
+        bridge.stop()  # must not wait for a sender that lost its stop marker
+        remote_socket.close()
+        self.assertTrue(peer.dropped)
+        self.assertEqual(peer.dropped + peer.sent, 10)
+
+
+if __name__ == '__main__':
+    unittest.main()
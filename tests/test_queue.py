@@ -0,0 +1,132 @@
+
+import shutil
+import tempfile
+import unittest
+
+from time import sleep, time
+
+from application.python.queue import EventQueue, PartitionedEventQueue, SegmentQueue, StopProcessing
+
+
+class SegmentQueueTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def get_all(self, queue):
+        return [queue.get_nowait() for i in xrange(queue.qsize())]
+
+    def test_read_interleaved_with_segment_rollover(self):
+        queue = SegmentQueue(self.directory, memory_limit=1, segment_size=200)
+        for event in range(5):
+            queue.put(event)
+        events = [queue.get(), queue.get()]  # maps the first segment
+        for event in range(5, 30):
+            queue.put(event)  # the first segment grows after it was mapped and the writer moves on to new segments
+        events.extend(self.get_all(queue))
+        self.assertEqual(events, range(30))
+        self.assertEqual(queue.qsize(), 0)
+
+    def test_save_and_load(self):
+        queue = SegmentQueue(self.directory, memory_limit=2, segment_size=200)
+        for event in range(20):
+            queue.put(event)
+        self.assertEqual([queue.get() for i in range(5)], range(5))
+        queue.save()
+        queue = SegmentQueue(self.directory, memory_limit=2, segment_size=200)
+        self.assertEqual(queue.qsize(), 15)
+        self.assertEqual(self.get_all(queue), range(5, 20))
+
+    def test_stop_marker_is_kept_in_memory(self):
+        queue = SegmentQueue(self.directory, memory_limit=1, segment_size=200)
+        for event in range(4):
+            queue.put(event)
+        queue.put(StopProcessing)
+        queue.put(4)
+        self.assertEqual(queue.qsize(), 6)
+        self.assertEqual(self.get_all(queue), [0, 1, 2, 3, StopProcessing, 4])
+
+    def test_stop_marker_is_not_saved(self):
+        queue = SegmentQueue(self.directory, memory_limit=1, segment_size=200)
+        for event in range(4):
+            queue.put(event)
+        queue.put(StopProcessing)
+        queue.save()
+        queue = SegmentQueue(self.directory, memory_limit=1, segment_size=200)
+        self.assertEqual(queue.qsize(), 4)
+        self.assertEqual(self.get_all(queue), range(4))
+
+    def test_load_skips_written_stop_marker(self):
+        queue = SegmentQueue(self.directory, memory_limit=1, segment_size=200)
+        for event in range(3):
+            queue.put(event)
+        queue._write(StopProcessing)  # as written by the earlier versions
+        queue.save()
+        queue = SegmentQueue(self.directory, memory_limit=1, segment_size=200)
+        self.assertEqual(queue.qsize(), 3)
+        self.assertEqual(self.get_all(queue), range(3))
+
+
+class EventQueueTest(unittest.TestCase):
+    def test_resume_full_queue(self):
+        handled = []
+        queue = EventQueue(handled.append, capacity=2, timeout=5)
+        queue.pause()
+        queue.start()
+        queue.put(1)
+        queue.put(2)
+        queue.resume([3])  # only the paused thread can make room for the event
+        queue.stop()
+        queue.join()
+        self.assertEqual(handled, [1, 2, 3])
+
+    def test_preload_over_capacity(self):
+        handled = []
+        queue = EventQueue(handled.append, preload=range(5), capacity=2)
+        queue.start()
+        queue.stop()
+        queue.join()
+        self.assertEqual(handled, range(5))
+
+    def test_handler_adds_events_on_full_queue(self):
+        handled = []
+        def handler(event):
+            handled.append(event)
+            if event < 3:
+                queue.put(event + 10)
+                queue.put(event + 20)
+        queue = EventQueue(handler, capacity=2)
+        queue.pause()
+        queue.start()
+        queue.put(1)
+        queue.put(2)
+        queue.unpause()
+        deadline = time() + 5
+        while len(handled) < 6 and time() < deadline:
+            sleep(0.001)
+        queue.stop()
+        queue.join(5)
+        self.assertFalse(queue.isAlive())
+        self.assertEqual(sorted(handled), [1, 2, 11, 12, 21, 22])
+
+
+class PartitionedEventQueueTest(unittest.TestCase):
+    def test_resize_after_stop(self):
+        queue = PartitionedEventQueue(lambda event: None, key=lambda event: event[0], workers=2)
+        queue.put(('a', 1))
+        queue.stop(force_exit=True)
+        self.assertRaises(RuntimeError, queue.resize, 3)
+        self.assertEqual(queue.workers, 2)
+        queue.put(('b', 2))  # must not wait for a resize that never finishes
+        self.assertEqual(sorted(queue.get_unhandled()), [('a', 1), ('b', 2)])
+
+    def test_preload_over_capacity(self):
+        queue = PartitionedEventQueue(lambda event: None, key=lambda event: event, workers=2, preload=range(10), capacity=2)
+        queue.stop(force_exit=True)
+        self.assertEqual(sorted(queue.get_unhandled()), range(10))
+
+
+if __name__ == '__main__':
+    unittest.main()